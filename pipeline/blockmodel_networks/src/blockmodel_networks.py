@@ -7,11 +7,23 @@ configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config["subreddits"]
 entity_score_threshold = config["entity_score_threshold"]
+# refine="basic" keeps the best of several fits, which can run in parallel
+refine = config.get("blockmodel_refine", False)
+n_init = config.get("blockmodel_n_init", 10)
+seed = config.get("blockmodel_seed", 0)
+n_jobs = config.get("blockmodel_n_jobs", 1)
+patience = config.get("blockmodel_patience", None)
 
 
 for r in subreddits:
     g = load_gt(f"{r}_author_network")
     auth_auth = return_graph_type(g, gtype=0)
-    blockmodel = create_blockmodel(auth_auth)
+    blockmodel = create_blockmodel(
+        auth_auth,
+        refine=refine,
+        seeds=range(seed, seed + n_init),
+        n_jobs=n_jobs,
+        patience=patience,
+    )
     gd = get_graph_data(blockmodel)
     save_parquet(gd, f"{r}_blockmodel")
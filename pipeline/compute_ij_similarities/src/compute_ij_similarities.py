@@ -1,4 +1,7 @@
 from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
+from podlm.utilities import task_cache_key, restore_task_outputs, store_task_outputs
+from podlm.utilities import load_embedding_store, embeddings_for_ids
+import logging
 
 from sentence_transformers import SentenceTransformer
 from podlm.text import compute_ij_cosine_similarity_before_datetime
@@ -6,17 +9,48 @@ from podlm.text import compute_ij_cosine_similarity_before_datetime
 configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config["subreddits"]
+ij_similarity_method = config.get("ij_similarity_method", "index")
 
-similarity_model = SentenceTransformer("all-MiniLM-L6-v2")
+similarity_model_name = "all-MiniLM-L6-v2"
+similarity_model = SentenceTransformer(similarity_model_name)
 
 for r in subreddits:
+    inputs = [
+        f"{r}_edges",
+        f"{r}_sentence_level_features_merged",
+        f"{r}_sentence_embeddings",
+    ]
+    key = task_cache_key(
+        __file__, config, ["ij_similarity_method"], inputs, [similarity_model_name]
+    )
+    if restore_task_outputs(key, [f"{r}_ij_similarity"]):
+        continue
     vdf = load_parquet(f"{r}_vertices")
     edf = load_parquet(f"{r}_edges")
 
-    tdf = load_parquet(f"{r}_sentence_level_features_merged")
-    tdf = tdf[["author", "sentence", "datetime"]]
+    tdf = load_parquet(
+        f"{r}_sentence_level_features_merged",
+        columns=["id_sentence", "author", "sentence", "datetime"],
+    )
+
+    # reuse the embeddings from label_topics if they were made with the same model
+    # (only the index method embeds each sentence on its own)
+    embeddings = None
+    if ij_similarity_method == "index":
+        store = load_embedding_store(f"{r}_sentence_embeddings")
+        if store["model"] == similarity_model_name:
+            embeddings = embeddings_for_ids(store, tdf["id_sentence"])
+        if embeddings is None:
+            logging.debug(
+                "No stored embeddings for these sentences, encoding them again."
+            )
 
     edf_csim = compute_ij_cosine_similarity_before_datetime(
-        edf, tdf, model=similarity_model
+        edf,
+        tdf,
+        model=similarity_model,
+        method=ij_similarity_method,
+        embeddings=embeddings,
     )
     save_parquet(edf_csim, f"{r}_ij_similarity")
+    store_task_outputs(key, [f"{r}_ij_similarity"])
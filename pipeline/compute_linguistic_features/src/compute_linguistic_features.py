@@ -1,17 +1,13 @@
 from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
-from podlm.text import count_parts_of_speech
 import logging
-import spacy
-nlp = spacy.load('en_core_web_sm', disable=['ner', 'textcat'])
 
 configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config['subreddits']
 
+# The features are computed in the same spaCy pass that segments the sentences
+# (segment_sentences). This task just hands them on to the downstream tasks.
 for r in subreddits:
-    df = load_parquet(f'{r}_sentences')    
-    df = count_parts_of_speech(df, nlp, 'sentence') 
-    logging.debug("Computed linguistic features with spacy.") 
+    df = load_parquet(f'{r}_linguistic_features')
+    logging.debug("Loaded linguistic features computed by segment_sentences.") 
     save_parquet(df, f'{r}_linguistic_features')
-    
-    
\ No newline at end of file
@@ -8,7 +8,10 @@ subreddits = config["subreddits"]
 
 
 for r in subreddits:
-    df = load_parquet(f"{r}_sentence_level_features_merged")
+    df = load_parquet(
+        f"{r}_sentence_level_features_merged",
+        columns=["author", "post_id", "parent_id", "datetime", "subreddit"],
+    )
     g = construct_network(df, "author", "post_id", "parent_id")
     save_gt(g, f"{r}_author_network")
     logging.debug("Constructed entity dataframes (long and counts)")
@@ -1,5 +1,5 @@
-from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
-from podlm.networks import load_gt, get_graph_dfs
+from podlm.utilities import load_configs, configure_logging
+from podlm.networks import load_gt, save_graph_parquet
 
 configure_logging(__file__)
 config, _ = load_configs()
@@ -8,6 +8,5 @@ subreddits = config["subreddits"]
 
 for r in subreddits:
     g = load_gt(f"{r}_author_network")
-    vdf, edf = get_graph_dfs(g, vtype=0, etype=0)
-    save_parquet(vdf, f"{r}_vertices")
-    save_parquet(edf, f"{r}_edges")
+    # same tables as get_graph_dfs(g, vtype=0, etype=0), written straight from arrays
+    save_graph_parquet(g, f"{r}_vertices", f"{r}_edges", vtype=0, etype=0)
@@ -1,16 +1,26 @@
 from transformers import pipeline
 from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
-from podlm.text import transformer_emotion_concepts
+from podlm.utilities import task_cache_key, restore_task_outputs, store_task_outputs, open_inference_cache
+from podlm.text import transformer_emotion_concepts, get_torch_device
 import logging
 
-model = pipeline(task="text-classification", model="SamLowe/roberta-base-go_emotions", top_k=None)
+model_name = "SamLowe/roberta-base-go_emotions"
+model = pipeline(task="text-classification", model=model_name, top_k=None, device=get_torch_device())
 
 configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config['subreddits']
+batch_size = config.get('emotion_batch_size', 32)
+cache = open_inference_cache(config)
 
 for r in subreddits:
+    key = task_cache_key(__file__, config, [], [f'{r}_sentences'], [model_name])
+    if restore_task_outputs(key, [f'{r}_emotion_concepts']):
+        continue
     df = load_parquet(f'{r}_sentences')
-    df = transformer_emotion_concepts(df, model, 'sentence', 'id_sentence')    
+    df = transformer_emotion_concepts(df, model, 'sentence', 'id_sentence', batch_size=batch_size, cache=cache)
     save_parquet(df, f'{r}_emotion_concepts')
-    logging.debug("Finished labelling emotion concepts.") 
\ No newline at end of file
+    store_task_outputs(key, [f'{r}_emotion_concepts'])
+    logging.debug("Finished labelling emotion concepts.")
+    if cache is not None:
+        logging.debug(f"Inference cache: {cache.stats()}") 
\ No newline at end of file
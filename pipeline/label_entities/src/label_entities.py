@@ -1,22 +1,33 @@
 from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
-from podlm.text import transformer_entities
+from podlm.utilities import task_cache_key, restore_task_outputs, store_task_outputs, open_inference_cache
+from podlm.text import transformer_entities, get_torch_device
 from span_marker import SpanMarkerModel
 import logging
 
 # print('🔥🔥🔥 conda activate entites 🔥🔥🔥')
 
-model = SpanMarkerModel.from_pretrained("lxyuan/span-marker-bert-base-multilingual-uncased-multinerd")
-model.cuda()
+model_name = "lxyuan/span-marker-bert-base-multilingual-uncased-multinerd"
+model = SpanMarkerModel.from_pretrained(model_name)
+model.to(get_torch_device())
 
 configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config['subreddits']
 entity_score_threshold = config['entity_score_threshold']
+batch_size = config.get('entity_batch_size', 32)
+cache = open_inference_cache(config)
 
 
 for r in subreddits:
+    outputs = [f'{r}_entities', f'{r}_entities_info']
+    key = task_cache_key(__file__, config, ['entity_score_threshold'], [f'{r}_sentences'], [model_name])
+    if restore_task_outputs(key, outputs):
+        continue
     df = load_parquet(f'{r}_sentences')
-    entities, entities_info = transformer_entities(df, model, entity_score_threshold, 'sentence', 'id_sentence')
+    entities, entities_info = transformer_entities(df, model, entity_score_threshold, 'sentence', 'id_sentence', batch_size=batch_size, cache=cache)
     save_parquet(entities, f'{r}_entities')
     save_parquet(entities_info, f'{r}_entities_info')
-    logging.debug("Constructed entity dataframes (long and counts)") 
\ No newline at end of file
+    store_task_outputs(key, outputs)
+    logging.debug("Constructed entity dataframes (long and counts)")
+    if cache is not None:
+        logging.debug(f"Inference cache: {cache.stats()}") 
\ No newline at end of file
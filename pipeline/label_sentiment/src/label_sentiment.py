@@ -1,20 +1,32 @@
 from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
-from podlm.text import transformer_sentiment
+from podlm.utilities import task_cache_key, restore_task_outputs, store_task_outputs, open_inference_cache
+from podlm.text import transformer_sentiment, get_torch_device
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 import logging
 
 # print('🔥🔥🔥 conda activate entities 🔥🔥🔥')
 
-model = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
-tokenizer = AutoTokenizer.from_pretrained(model, max_len=512)
-model = AutoModelForSequenceClassification.from_pretrained(model)
+model_name = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
+tokenizer = AutoTokenizer.from_pretrained(model_name, max_len=512)
+model = AutoModelForSequenceClassification.from_pretrained(model_name)
+model.to(get_torch_device())
 
 configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config['subreddits']
+batch_size = config.get('sentiment_batch_size', 32)
+# sentences labelled before (in any analysis) are looked up instead of classified again
+cache = open_inference_cache(config)
 
 for r in subreddits:
+    # batch size doesn't change the scores, so it isn't part of the cache key
+    key = task_cache_key(__file__, config, [], [f'{r}_sentences'], [model_name])
+    if restore_task_outputs(key, [f'{r}_sentiment']):
+        continue
     df = load_parquet(f'{r}_sentences')
-    df = transformer_sentiment(df, model, tokenizer)
+    df = transformer_sentiment(df, model, tokenizer, batch_size=batch_size, cache=cache)
     save_parquet(df, f'{r}_sentiment')
-    logging.debug("Finished sentiment analysis.") 
\ No newline at end of file
+    store_task_outputs(key, [f'{r}_sentiment'])
+    logging.debug("Finished sentiment analysis.")
+    if cache is not None:
+        logging.debug(f"Inference cache: {cache.stats()}") 
\ No newline at end of file
@@ -1,6 +1,14 @@
 import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
 from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
-from podlm.text import transformer_topics
+from podlm.utilities import task_cache_key, restore_task_outputs, store_task_outputs, open_inference_cache
+from podlm.utilities import create_embedding_store, load_embedding_store, fill_from_embedding_store
+from podlm.text import transformer_topics, update_topics, encode_sentences
+from sentence_transformers import SentenceTransformer
+from bertopic import BERTopic
 import logging
 
 # print('🔥🔥🔥 conda activate entities 🔥🔥🔥')
@@ -14,20 +22,97 @@ umap_n_neighbors = config['umap_n_neighbors']
 umap_n_components = config['umap_n_components']
 hdbscan_min_cluster_size = config['hdbscan_min_cluster_size']
 mmr_model_diversity = config['mmr_model_diversity']
+# fit on a sample of sentences and assign the rest in batches (None fits on all of them)
+fit_sample_size = config.get('topic_fit_sample_size', None)
+transform_batch_size = config.get('topic_transform_batch_size', 100000)
+# sentence embeddings are cached, the topic model itself is fit every time
+cache = open_inference_cache(config)
+# the sentence embeddings are saved for later tasks (e.g. compute_ij_similarities)
+embedding_dtype = config.get('embedding_dtype', 'float16')
+embedder = SentenceTransformer(sentence_transformer_model)
 
+# incremental mode keeps the last run's topics and only assigns topics to new sentences
+# with the saved model, until they add up to topic_refit_fraction of the sentences
+# the model was fit on. Then the model is fit from scratch again.
+incremental = config.get('topic_incremental', False)
+refit_fraction = config.get('topic_refit_fraction', 0.5)
+merge_new = config.get('topic_merge_new', False)
+
+topic_config_keys = ['sentence_transformer_model', 'umap_n_neighbors', 'umap_n_components',
+                     'hdbscan_min_cluster_size', 'mmr_model_diversity', 'embedding_dtype', 'topic_fit_sample_size']
+topic_params = dict(umap_n_neighbors=umap_n_neighbors,
+                    umap_n_components=umap_n_components,
+                    hdbscan_min_cluster_size=hdbscan_min_cluster_size,
+                    mmr_model_diversity=mmr_model_diversity,
+                    fit_sample_size=fit_sample_size,
+                    transform_batch_size=transform_batch_size)
 
 for r in subreddits:
+    outputs = [f'{r}_topics', f'{r}_topic_info', f'{r}_model_safetensors', f'{r}_sentence_embeddings']
+    model_dir = f'../output/{r}_model_safetensors'
+    state_path = os.path.join(model_dir, 'podlm_topic_state.json')
+    # incremental results depend on the previous outputs, not just the inputs, so they aren't cached
+    key = None if incremental else task_cache_key(__file__, config, topic_config_keys, [f'{r}_sentences'])
+    if restore_task_outputs(key, outputs):
+        continue
     df = load_parquet(f'{r}_sentences')
-    # topics, topic_info, topic_model = transformer_topics(df, model="all-MiniLM-L6-v2", textcol='sentence')
-    topics, topic_info, topic_model = transformer_topics(df,
-                                                         model=sentence_transformer_model, 
-                                                         umap_n_neighbors=umap_n_neighbors,
-                                                         umap_n_components=umap_n_components,
-                                                         hdbscan_min_cluster_size=hdbscan_min_cluster_size,
-                                                         mmr_model_diversity=mmr_model_diversity,
-                                                         textcol='sentence')
+
+    previous, state = None, None
+    store_path = f'../output/{r}_sentence_embeddings'
+    if incremental and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        previous = pd.read_parquet(f'../output/{r}_topics.parquet.gzip',
+                                   columns=['id_sentence', 'topic', 'topic_probability'])
+
+    # the new embeddings are written to a temporary store and only replace the current
+    # one once every row is encoded, so a crashed run never leaves a partial store
+    # behind (the current store is the one the next incremental run copies from)
+    for stale in [f'{store_path}_tmp', f'{store_path}_previous']:
+        if os.path.exists(stale):
+            shutil.rmtree(stale)
+    embeddings = create_embedding_store(f'{r}_sentence_embeddings_tmp', df['id_sentence'],
+                                        embedder.get_sentence_embedding_dimension(),
+                                        sentence_transformer_model, embedding_dtype)
+    missing = np.ones(len(df), dtype=bool)
+    if previous is not None and os.path.exists(store_path):
+        previous_store = load_embedding_store(f'{r}_sentence_embeddings', '../output')
+        if previous_store['model'] == sentence_transformer_model:
+            missing = fill_from_embedding_store(previous_store, df['id_sentence'], embeddings)
+        del previous_store
+    if missing.all():
+        encode_sentences(df['sentence'].tolist(), embedder, out=embeddings, cache=cache)
+    elif missing.any():
+        embeddings[missing] = encode_sentences(df['sentence'][missing].tolist(), embedder, cache=cache)
+    embeddings.flush()
+    del embeddings
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(f'{store_path}_tmp', store_path)
+    embeddings = load_embedding_store(f'{r}_sentence_embeddings', '../output')['embeddings']
+
+    n_new = int((~df['id_sentence'].isin(previous['id_sentence'])).sum()) if previous is not None else 0
+    if previous is not None and state['n_since_fit'] + n_new <= refit_fraction * state['n_fit']:
+        topic_model = BERTopic.load(model_dir, embedding_model=embedder)
+        topics, topic_info, topic_model, n_new = update_topics(df, topic_model, previous, embeddings,
+                                                               merge_new=merge_new,
+                                                               embedding_model=embedder,
+                                                               **topic_params)
+        state = {'n_fit': state['n_fit'], 'n_since_fit': state['n_since_fit'] + n_new}
+        logging.debug(f"Assigned topics to {n_new} new sentences with the saved model.")
+    else:
+        # topics, topic_info, topic_model = transformer_topics(df, model="all-MiniLM-L6-v2", textcol='sentence')
+        topics, topic_info, topic_model = transformer_topics(df,
+                                                             model=embedder,
+                                                             textcol='sentence',
+                                                             embeddings=embeddings,
+                                                             **topic_params)
+        state = {'n_fit': min(fit_sample_size or len(df), len(df)), 'n_since_fit': 0}
     save_parquet(topics, f'{r}_topics')
     save_parquet(topic_info, f'{r}_topic_info')
-    os.makedirs(f'../output/{r}_model_safetensors', exist_ok=True)
-    topic_model.save(f'../output/{r}_model_safetensors', serialization="safetensors", save_ctfidf=True)
-    logging.debug("Finished labelling topics.")
\ No newline at end of file
+    os.makedirs(model_dir, exist_ok=True)
+    topic_model.save(model_dir, serialization="safetensors", save_ctfidf=True)
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+    store_task_outputs(key, outputs)
+    logging.debug("Finished labelling topics.")
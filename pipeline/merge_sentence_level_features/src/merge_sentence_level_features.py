@@ -2,20 +2,24 @@ from podlm.utilities import (
     load_configs,
     configure_logging,
     load_parquet,
-    save_parquet,
     split_ids,
+    arrow_schema,
+    resolve_column_collisions,
+    iter_merged_on_key,
+    save_parquet_chunks,
 )
-from functools import reduce
-import pandas as pd
 import logging
 
 configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config["subreddits"]
+chunk_size = config.get("merge_chunk_size", 100000)
+arrow_dtypes = config.get("arrow_dtypes", True)
+dtype_backend = config.get("parquet_dtype_backend", None)
+row_group_size = config.get("merge_row_group_size", 100000)
 
 
 for r in subreddits:
-    to_merge = []
     tasks = [
         "emotion_concepts",
         "entities",
@@ -23,18 +27,17 @@ for r in subreddits:
         "topics",
         "linguistic_features",
     ]
-    for task in tasks:
-        df = load_parquet(f"{r}_{task}")
-        df = split_ids(df)
-        to_merge.append(df)
-    merged = reduce(
-        lambda left, right: pd.merge(left, right, on="id_sentence"), to_merge
-    )
-
-    post_level_data = load_parquet(f"{r}_post_level_subcom_merged")
+    to_merge = {
+        task: load_parquet(
+            f"{r}_{task}", arrow_dtypes=arrow_dtypes, dtype_backend=dtype_backend
+        )
+        for task in tasks
+    }
 
-    authors_and_post_ids = post_level_data[
-        [
+    # only read the post columns that are kept (the post texts are the bulk of the file)
+    authors_and_post_ids = load_parquet(
+        f"{r}_post_level_subcom_merged",
+        columns=[
             "author",
             "id",
             "parent_id",
@@ -45,18 +48,26 @@ for r in subreddits:
             "num_comments",
             "url",
             "domain",
-        ]
-    ].copy()
+        ],
+        arrow_dtypes=arrow_dtypes,
+        dtype_backend=dtype_backend,
+    )
 
-    authors_and_post_ids.loc[:, "post_id"] = authors_and_post_ids["id"]
-    authors_and_post_ids.drop("id", axis=1, inplace=True)
+    authors_and_post_ids.rename(columns={"id": "post_id"}, inplace=True)
     authors_and_post_ids.reset_index(drop=True, inplace=True)
-    with_authors = pd.merge(authors_and_post_ids, merged, on="post_id")
-    dropcols = [c for c in with_authors.columns if c.endswith("_x") or c.endswith("_y")]
-    for dc in dropcols:
-        try:
-            with_authors.drop(dc, axis=1, inplace=True)
-        except:
-            pass
-    save_parquet(with_authors, f"{r}_sentence_level_features_merged")
+
+    # rename clashing columns (e.g. the entity score and the post score) up front
+    resolved = resolve_column_collisions(
+        {**to_merge, "post": authors_and_post_ids}, keys=["id_sentence", "post_id"]
+    )
+    posts = resolved.pop("post").set_index("post_id")
+    schema_hint = arrow_schema(*resolved.values(), posts.reset_index())
+
+    chunks = (
+        split_ids(chunk).join(posts, on="post_id", how="inner")
+        for chunk in iter_merged_on_key(resolved, "id_sentence", chunk_size)
+    )
+    save_parquet_chunks(
+        chunks, f"{r}_sentence_level_features_merged", schema_hint, row_group_size
+    )
     logging.debug("Completed sentence-level merge.")
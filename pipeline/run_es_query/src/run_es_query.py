@@ -1,15 +1,47 @@
 from elasticsearch import Elasticsearch
-from podlm.utilities import load_configs, configure_logging, save_parquet
-from podlm.reddit import es_query_reddit
+from podlm.utilities import load_configs, configure_logging
+from podlm.reddit import (es_parallel_stream_reddit_to_parquet, sample_dataset_ids,
+                          filter_dataset_by_ids, es_stream_comments_for_submissions)
 import logging
 
 configure_logging(__file__)
 config, private = load_configs()
 subreddits = config['subreddits']
+chunk_size = config.get('es_chunk_size', 10000)
+n_slices = config.get('es_slices', 2)
+max_workers = config.get('es_max_workers', 4)
+# incremental mode only fetches documents newer than the watermarks from the last run
+watermarks_path = '../output/es_watermarks.json' if config.get('es_incremental', False) else None
+lookback = config.get('es_lookback_seconds', 86400)
+# sample pushdown only fetches the sampled submissions and their comments
+sample_pushdown = config.get('es_sample_pushdown', False)
+if sample_pushdown and watermarks_path:
+    raise ValueError("es_sample_pushdown and es_incremental can't be combined.")
 es = Elasticsearch(private['es_host'], verify_certs = private['es_verify_certs'])
 
+if sample_pushdown:
+    # submissions are fetched in full (only the projected fields), sampled down to
+    # sample_n_conversations, and only the comments replying to those are fetched
+    n = config['sample_n_conversations']
+    counts = es_parallel_stream_reddit_to_parquet(subreddits, es, '../output', n_slices=n_slices,
+                                                  max_workers=max_workers, chunk_size=chunk_size,
+                                                  indices=['reddit-index-s'])
+    for r in subreddits:
+        path = f'../output/{r}_submissions'
+        ids = sample_dataset_ids(path, n)
+        filter_dataset_by_ids(path, ids)
+        # link_id is the submission of every comment in its thread, parent_id only of direct replies
+        field = 'link_id' if config.get('sample_full_threads', False) else 'parent_id'
+        counts[(r, 'reddit-index-c')] = es_stream_comments_for_submissions(
+            r, es, ids, f'../output/{r}_comments', field=field, max_workers=max_workers, chunk_size=chunk_size)
+        counts[(r, 'reddit-index-s')] = len(ids)
+else:
+    # all subreddits, both indices, and n_slices sliced scrolls per index are fetched
+    # concurrently and streamed into parquet datasets partitioned by ymd, e.g.
+    # ../output/{r}_submissions/ymd=2023-10-31/
+    counts = es_parallel_stream_reddit_to_parquet(subreddits, es, '../output', n_slices=n_slices,
+                                                  max_workers=max_workers, chunk_size=chunk_size,
+                                                  watermarks_path=watermarks_path, lookback=lookback)
 for r in subreddits:
-    subs, coms = es_query_reddit(r, es)
-    logging.debug(f"ES query returned {len(subs)} submissions and {len(coms)} comments.") 
-    save_parquet(subs, f'{r}_submissions')
-    save_parquet(coms, f'{r}_comments')
\ No newline at end of file
+    n_subs, n_coms = counts[(r, 'reddit-index-s')], counts[(r, 'reddit-index-c')]
+    logging.debug(f"ES query returned {n_subs} new submissions and {n_coms} new comments for r/{r}.") 
@@ -1,16 +1,30 @@
-from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
-from podlm.reddit import sample_discussions
+from podlm.utilities import load_configs, configure_logging, save_parquet
+from podlm.reddit import sample_discussions, load_reddit_dataset, sample_discussions_from_datasets
 import logging
 
 configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config['subreddits']
 n_conversations = config['sample_n_conversations']
+# keep every comment in the sampled threads, not just the direct replies to submissions
+full_threads = config.get('sample_full_threads', False)
+# stream the sample from the datasets (hash-based, optionally stratified) instead of
+# loading both datasets and sampling uniformly
+streaming = config.get('sample_streaming', False)
+stratify = config.get('sample_stratify', None)
+allocation = config.get('sample_allocation', 'proportional')
+seed = config.get('sample_seed', 42)
 
 for r in subreddits:
-    subs = load_parquet(f'{r}_submissions')
-    coms = load_parquet(f'{r}_comments')
-    subs, coms = sample_discussions(subs, coms, n=n_conversations)
+    if streaming:
+        subs, coms = sample_discussions_from_datasets(f'../input/{r}_submissions', f'../input/{r}_comments',
+                                                      n=n_conversations, stratify=stratify,
+                                                      allocation=allocation, full_threads=full_threads,
+                                                      seed=seed)
+    else:
+        subs = load_reddit_dataset(f'../input/{r}_submissions')
+        coms = load_reddit_dataset(f'../input/{r}_comments')
+        subs, coms = sample_discussions(subs, coms, n=n_conversations, full_threads=full_threads)
     logging.debug(f"Sampled {len(subs)} conversations.") 
     save_parquet(subs, f'{r}_submissions')
-    save_parquet(coms, f'{r}_comments')
\ No newline at end of file
+    save_parquet(coms, f'{r}_comments')
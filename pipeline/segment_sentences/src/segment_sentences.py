@@ -1,5 +1,6 @@
 from podlm.utilities import load_configs, configure_logging, load_parquet, save_parquet
-from podlm.text import split_sentences
+from podlm.utilities import task_cache_key, restore_task_outputs, store_task_outputs
+from podlm.text import split_sentences_with_linguistic_features
 import pandas as pd
 import logging
 import spacy
@@ -10,9 +11,19 @@ nlp = spacy.load('en_core_web_sm', disable=['ner', 'textcat'])
 configure_logging(__file__)
 config, _ = load_configs()
 subreddits = config['subreddits']
+n_process = config.get('spacy_n_process', 1)
+batch_size = config.get('spacy_batch_size', 1000)
+arrow_dtypes = config.get('arrow_dtypes', True)
 
 for r in subreddits:
+    outputs = [f'{r}_sentences', f'{r}_linguistic_features']
+    key = task_cache_key(__file__, config, ['arrow_dtypes'], [f'{r}_post_level_subcom_merged'], ['en_core_web_sm', spacy.__version__])
+    if restore_task_outputs(key, outputs):
+        continue
     df = load_parquet(f'{r}_post_level_subcom_merged')
-    df = split_sentences(df, nlp, 'text', 'id')
+    # one spaCy pass produces the sentences AND the linguistic features (see compute_linguistic_features)
+    df, features = split_sentences_with_linguistic_features(df, nlp, 'text', 'id', n_process=n_process, batch_size=batch_size, arrow_dtypes=arrow_dtypes)
     logging.debug("Extracted sentences from posts and assigned sentence-level ids.") 
-    save_parquet(df, f'{r}_sentences')
\ No newline at end of file
+    save_parquet(df, f'{r}_sentences')
+    save_parquet(features, f'{r}_linguistic_features')
+    store_task_outputs(key, outputs)
@@ -1,6 +1,10 @@
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import graph_tool.all as gt
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 def save_gt(g, filename):
@@ -27,99 +31,146 @@ def add_vertex_names_to_edf(vdf, edf, drop_duplicates=False):
     and then when I query the text dataframe, I can concatenate all the sentences that match
     that specific timestamp, or come before it. - John
     """
-    lookup_dict = {}
-    for vid, auth in zip(vdf["vid"], vdf["author"]):
-        lookup_dict[vid] = auth
-    edf["source_author"] = edf["source"].map(lookup_dict)
-    edf["target_author"] = edf["target"].map(lookup_dict)
+    lookup = pd.Series(vdf["author"].to_numpy(), index=vdf["vid"].to_numpy())
+    edf["source_author"] = edf["source"].map(lookup)
+    edf["target_author"] = edf["target"].map(lookup)
     if drop_duplicates is True:
         edf.drop_duplicates(inplace=True)
     return edf
 
 
-def get_graph_dfs(g, vtype: int = None, etype: int = None, drop_duplicates=True):
-    """
-    This function returns two dataframes: one for vertices and one for edges.
-    The idea is to use this to compute ij similarities for a given graph.
+def get_graph_arrays(g, vtype: int = None, etype: int = None, drop_duplicates=True):
     """
+    Returns the columns of the vertex and edge tables of `get_graph_dfs` as two
+    dicts of arrays. Everything comes from `g.get_edges` and the property maps'
+    `.a` arrays, and vertex names are joined to the edges by array indexing, so
+    nothing loops over the edges in Python.
 
-    vdf = []
-    for v in g.vertices():
-        vdf.append([int(v), int(g.vp.vtype[v]), str(g.vp.ids[v])])
-    vdf = pd.DataFrame(vdf)
-    vdf.columns = ["vid", "vtype", "author"]
+    With `drop_duplicates`, repeated (source, target, etype, time) edges, e.g. one
+    per sentence of the same post, are collapsed into the first one.
+    """
+    vids = g.get_vertices()
+    names = np.asarray(list(g.vp.ids), dtype=object)
+    vtypes = g.vp.vtype.a[vids]
     if vtype is not None:
-        vdf = vdf[vdf["vtype"] == vtype]
+        keep = vtypes == vtype
+        vids, names, vtypes = vids[keep], names[keep], vtypes[keep]
 
-    edf = []
-    for e in g.edges():
-        edf.append(
-            [int(e.source()), int(e.target()), int(g.ep.etype[e]), int(g.ep.time[e])]
-        )
-    edf = pd.DataFrame(edf)
-    edf.columns = ["source", "target", "etype", "etime"]
+    edges = g.get_edges([g.ep.etype, g.ep.time]).astype("int64")
     if etype is not None:
-        edf = edf[edf["etype"] == etype]
-    edf["datetime"] = pd.to_datetime(edf["etime"], unit="s", utc=True)
+        edges = edges[edges[:, 2] == etype]
     if drop_duplicates is True:
-        edf = add_vertex_names_to_edf(vdf, edf, drop_duplicates=True)
-    else:
-        edf = add_vertex_names_to_edf(vdf, edf, drop_duplicates=False)
+        _, first = np.unique(edges, axis=0, return_index=True)
+        edges = edges[np.sort(first)]
+
+    # vertices that were filtered out by vtype get no name, like in add_vertex_names_to_edf
+    lookup = np.full(g.num_vertices(ignore_filter=True), None, dtype=object)
+    lookup[vids] = names
+    vertices = {"vid": vids.astype("int64"), "vtype": vtypes, "author": names}
+    edges = {
+        "source": edges[:, 0],
+        "target": edges[:, 1],
+        "etype": edges[:, 2],
+        "etime": edges[:, 3],
+        "datetime": edges[:, 3].astype("datetime64[s]"),
+        "source_author": lookup[edges[:, 0]],
+        "target_author": lookup[edges[:, 1]],
+    }
+    return vertices, edges
+
+
+def get_graph_dfs(g, vtype: int = None, etype: int = None, drop_duplicates=True):
+    """
+    This function returns two dataframes: one for vertices and one for edges.
+    The idea is to use this to compute ij similarities for a given graph.
+    """
+    vertices, edges = get_graph_arrays(g, vtype, etype, drop_duplicates)
+    vdf = pd.DataFrame(vertices)
+    edf = pd.DataFrame(edges)
+    edf["datetime"] = edf["datetime"].dt.tz_localize("UTC")
     return vdf, edf
 
 
-def construct_network(
-    df: pd.DataFrame, authorcol: str, idcol: str, parentidcol: str
-):  # output_path = None, net_type = 'subreddit'
-    # node and edge types:
-    # 0 = author
-    # 1 = subreddit
-    # 2 = topic
+def save_graph_parquet(
+    g,
+    vertices_filename: str,
+    edges_filename: str,
+    vtype: int = None,
+    etype: int = None,
+    drop_duplicates=True,
+):
+    """
+    Writes the vertex and edge tables of `get_graph_dfs` straight from arrays to
+    ../output/{vertices_filename}.parquet.gzip and ../output/{edges_filename}.parquet.gzip,
+    without building pandas dataframes in between.
+    """
+    vertices, edges = get_graph_arrays(g, vtype, etype, drop_duplicates)
+    edges["datetime"] = pa.array(edges["datetime"], type=pa.timestamp("s", tz="UTC"))
+    for columns, filename in [(vertices, vertices_filename), (edges, edges_filename)]:
+        table = pa.table(columns)
+        pq.write_table(table, f"../output/{filename}.parquet.gzip", compression="gzip")
 
-    df = df[df[authorcol] != "[deleted]"].copy()
-    df["epoch"] = (
+
+def network_edge_list(df: pd.DataFrame, authorcol: str, idcol: str, parentidcol: str):
+    """
+    Builds the edge list of `construct_network` as arrays. Returns an (n_edges x 4)
+    int64 array of (source, target, etype, time) rows with integer vertex ids, the
+    name of each vertex id, and each vertex's type (0 = author, 1 = subreddit).
+
+    The edges are the reply edges (author -> author of the parent post, etype 0)
+    followed by the subreddit edges (author -> subreddit, etype 1). Vertex ids are
+    numbered in order of first appearance in the edge list, like the hashed
+    graph-tool constructor numbers them.
+    """
+    df = df[df[authorcol] != "[deleted]"]
+    epoch = (
         (df["datetime"] - pd.Timestamp("1970-01-01", tz="UTC"))
         .astype("timedelta64[s]")
         .astype("int64")
+        .to_numpy()
     )
+    authors = df[authorcol].to_numpy()
 
-    df["author_type"] = 0
-    df["subreddit_type"] = 1
-    df["topic_type"] = 2
+    # the author of each row's parent post (if it's in df, the last match wins)
+    posts = df.drop_duplicates(idcol, keep="last")
+    parents = pd.Index(posts[idcol]).get_indexer(df[parentidcol])
+    author_to = posts[authorcol].to_numpy()[parents]
+    replies = (parents >= 0) & pd.notna(author_to)
 
-    post_auth_dict = dict(zip(df[idcol], df[authorcol]))
+    n = int(replies.sum())
+    sources = np.concatenate([authors[replies], authors[replies]])
+    targets = np.concatenate([author_to[replies], df["subreddit"].to_numpy()[replies]])
+    codes, names = pd.factorize(np.column_stack([sources, targets]).ravel())
+    edges = np.empty((2 * n, 4), dtype="int64")
+    edges[:, :2] = codes.reshape(-1, 2)
+    edges[:n, 2], edges[n:, 2] = 0, 1
+    edges[:, 3] = np.concatenate([epoch[replies], epoch[replies]])
 
-    df["author_to"] = df[parentidcol].map(post_auth_dict)
-    df.dropna(subset=["author_to"], inplace=True)
+    vtype = np.zeros(len(names), dtype="int32")
+    vtype[edges[n:, 1]] = 1
+    return edges, np.asarray(names, dtype=object), vtype
 
-    df_add = pd.DataFrame()
-    df_add["source"] = df[authorcol].tolist() + df[authorcol].tolist()
-    df_add["target"] = df["author_to"].tolist() + df["subreddit"].tolist()
-    df_add["type"] = df["author_type"].tolist() + df["subreddit_type"].tolist()
-    df_add["epoch"] = df["epoch"].tolist() + df["epoch"].tolist()
 
-    g = gt.Graph(
-        list(zip(df_add["source"], df_add["target"], df_add["type"], df_add["epoch"])),
-        hashed=True,
-        hash_type="string",
-        directed=True,
-        eprops=[("etype", "int"), ("time", "int")],
-    )
-
-    vtype = g.new_vertex_property("int")
-
-    g.vp.vtype = vtype
-
-    auth_list = list(set(df[authorcol].tolist() + df["author_to"].tolist()))
-    subreddit_list = list(set(df["subreddit"].tolist()))
-    #    topic_list = list(set(df['topic'].tolist()))
+def construct_network(
+    df: pd.DataFrame, authorcol: str, idcol: str, parentidcol: str
+):  # output_path = None, net_type = 'subreddit'
+    # node and edge types:
+    # 0 = author
+    # 1 = subreddit
+    # 2 = topic
 
-    vertex_lookup = dict(zip(g.vp.ids, range(len(list(g.vp.ids)))))
-    for v in auth_list:
-        g.vp.vtype[vertex_lookup[v]] = 0
+    # the edge list and vertex types are built with pandas/numpy (see network_edge_list),
+    # so graph-tool only has to copy arrays
+    edges, names, vtype = network_edge_list(df, authorcol, idcol, parentidcol)
 
-    for v in subreddit_list:
-        g.vp.vtype[vertex_lookup[v]] = 1
+    g = gt.Graph(directed=True)
+    g.add_vertex(len(names))
+    g.ep.etype = g.new_edge_property("int")
+    g.ep.time = g.new_edge_property("int")
+    g.add_edge_list(edges, eprops=[g.ep.etype, g.ep.time])
+    g.vp.ids = g.new_vertex_property("string", vals=names)
+    g.vp.vtype = g.new_vertex_property("int")
+    g.vp.vtype.a = vtype
 
     #    for v in topic_list:
     #        g.vp.vtype[vertex_lookup[v]] = 2
@@ -135,6 +186,105 @@ def construct_network(
     return g
 
 
+def _to_seconds(duration) -> int:
+    if isinstance(duration, (int, np.integer)):
+        return int(duration)
+    return int(pd.Timedelta(duration).total_seconds())
+
+
+def iter_network_windows(
+    g, window, step=None, etype: int = 0, start: int = None, end: int = None
+):
+    """
+    Yields one snapshot of `g` per time window [t, t + window), with t moving from
+    `start` to `end` (the first and last edge time by default) in steps of `step`.
+    `window` and `step` are seconds or anything `pd.Timedelta` understands, e.g.
+    "7D". By default `step` equals `window`, so the windows don't overlap. If
+    `step` is smaller, they slide.
+
+    The edges (of type `etype`, or all of them if it's None) are sorted by time
+    once. Each snapshot is a dict with the window bounds, `graph` (a GraphView of
+    `g` whose edge filter only lets through the edges in the window), and stats
+    that are updated incrementally as the window slides, by looking only at the
+    edges that enter or leave it:
+    - `n_edges`: edges in the window
+    - `n_vertices`: vertices with at least one of them
+    - `n_dyads`: distinct (source, target) pairs
+
+    The edge filter is one property map that is updated in place, so nothing is
+    copied per window. It also means a snapshot's graph is only valid until the
+    next one is yielded. Use `gt.Graph(snapshot["graph"], prune=True)` to keep one.
+    """
+    window = _to_seconds(window)
+    step = window if step is None else _to_seconds(step)
+    edges = g.get_edges([g.edge_index, g.ep.etype, g.ep.time]).astype("int64")
+    if etype is not None:
+        edges = edges[edges[:, 3] == etype]
+    edges = edges[np.argsort(edges[:, 4], kind="stable")]
+    times = edges[:, 4]
+    if len(times) == 0:
+        return
+    start = int(times[0]) if start is None else _to_seconds(start)
+    end = int(times[-1]) + 1 if end is None else _to_seconds(end)
+
+    n = g.num_vertices(ignore_filter=True)
+    efilt = g.new_edge_property("bool")
+    degree = np.zeros(n, dtype="int64")
+    dyads = Counter()
+    n_vertices = 0
+
+    def update(rows, sign):
+        nonlocal n_vertices
+        if len(rows) == 0:
+            return
+        efilt.a[edges[rows, 2]] = sign > 0
+        ends = edges[rows, :2].ravel()
+        touched = np.unique(ends)
+        before = np.count_nonzero(degree[touched])
+        np.add.at(degree, ends, sign)
+        n_vertices += np.count_nonzero(degree[touched]) - before
+        pairs, counts = np.unique(
+            edges[rows, 0] * n + edges[rows, 1], return_counts=True
+        )
+        for pair, count in zip(pairs.tolist(), counts.tolist()):
+            dyads[pair] += sign * count
+            if dyads[pair] == 0:
+                del dyads[pair]
+
+    lo = hi = 0
+    for t in range(start, end, step):
+        new_lo, new_hi = np.searchsorted(times, [t, t + window], side="left")
+        # edges that left the window, then edges that entered it
+        update(np.arange(lo, min(hi, new_lo)), -1)
+        update(np.arange(max(hi, new_lo), new_hi), 1)
+        lo, hi = new_lo, new_hi
+        yield {
+            "start": t,
+            "end": t + window,
+            "graph": gt.GraphView(g, efilt=efilt),
+            "n_edges": int(hi - lo),
+            "n_vertices": int(n_vertices),
+            "n_dyads": len(dyads),
+        }
+
+
+def network_window_stats(g, window, step=None, etype: int = 0) -> pd.DataFrame:
+    """
+    The stats of `iter_network_windows`, one row per window, with the window
+    bounds as UTC datetimes.
+    """
+    stats = [
+        {k: v for k, v in snapshot.items() if k != "graph"}
+        for snapshot in iter_network_windows(g, window, step, etype)
+    ]
+    stats = pd.DataFrame(
+        stats, columns=["start", "end", "n_edges", "n_vertices", "n_dyads"]
+    )
+    for col in ["start", "end"]:
+        stats[col] = pd.to_datetime(stats[col], unit="s", utc=True)
+    return stats
+
+
 def return_graph_type(g, gtype=0):
     # 0 = author
     # 1 = subreddit
@@ -146,18 +296,133 @@ def return_graph_type(g, gtype=0):
     return g1
 
 
-def create_blockmodel(graph, recs=None, rec_types=None, covars=False, refine=False):
-    global bs
-    bs = []
+# the graph each blockmodel worker process fits (see fit_nested_blockmodels)
+_blockmodel_graph = None
+
 
+def _init_blockmodel_worker(graph):
+    global _blockmodel_graph
+    _blockmodel_graph = graph
+
+
+def _minimize_nested_blockmodel(graph, seed, recs, rec_types):
+    if seed is not None:
+        gt.seed_rng(seed)
+        np.random.seed(seed)
     clabel = graph.vp["vtype"]
+    return gt.minimize_nested_blockmodel_dl(
+        graph,
+        state_args=dict(
+            deg_corr=True,
+            recs=recs,
+            rec_types=rec_types,
+            clabel=clabel,
+            pclabel=clabel,
+        ),
+    )
+
 
-    def collect_partitions(s):
-        global bs
-        bs.append(s.get_bs())
+def _blockmodel_run(seed, rec_names, rec_types):
+    g = _blockmodel_graph
+    recs = [g.ep[name] for name in rec_names]
+    state = _minimize_nested_blockmodel(g, seed, recs, rec_types)
+    return state.entropy(), state.get_bs()
 
-    callback = collect_partitions
 
+def _take_best(results, patience: int = None):
+    """
+    Returns the result with the lowest description length from an iterable of
+    (description length, result) pairs. Stops reading once the best hasn't
+    improved for `patience` results in a row.
+    """
+    best, best_dl, since_best = None, np.inf, 0
+    for dl, result in results:
+        if dl < best_dl:
+            best, best_dl, since_best = result, dl, 0
+        else:
+            since_best += 1
+        if patience is not None and since_best >= patience:
+            break
+    return best
+
+
+def fit_nested_blockmodels(
+    graph, seeds, recs=(), rec_types=(), n_jobs: int = 1, patience: int = None
+):
+    """
+    Runs `minimize_nested_blockmodel_dl` once per seed and returns the state with
+    the lowest description length. Runs are independent, so with `n_jobs` > 1 they
+    are spread over a process pool. Each worker gets its own copy of the graph once
+    (with filtered vertices and edges pruned, so a GraphView works too). The
+    covariates in `recs` then have to be internal edge properties of the graph.
+
+    Results are compared in seed order, and once the best hasn't improved for
+    `patience` runs, the remaining runs are cancelled. For the same seeds, the
+    result doesn't depend on `n_jobs`.
+    """
+    if n_jobs <= 1:
+        states = (
+            _minimize_nested_blockmodel(graph, seed, list(recs), list(rec_types))
+            for seed in seeds
+        )
+        return _take_best(((s.entropy(), s) for s in states), patience)
+
+    rec_names = []
+    for rec in recs:
+        names = [name for name, p in graph.ep.items() if p is rec]
+        if len(names) == 0:
+            raise ValueError("recs have to be internal edge properties of the graph.")
+        rec_names.append(names[0])
+    graph = gt.Graph(graph, prune=True)
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        initializer=_init_blockmodel_worker,
+        initargs=(graph,),
+    ) as pool:
+        futures = [
+            pool.submit(_blockmodel_run, seed, rec_names, list(rec_types))
+            for seed in seeds
+        ]
+        bs = _take_best((f.result() for f in futures), patience)
+        for future in futures:
+            future.cancel()
+    clabel = graph.vp["vtype"]
+    return gt.NestedBlockState(
+        graph,
+        bs=bs,
+        state_args=dict(
+            deg_corr=True,
+            recs=[graph.ep[name] for name in rec_names],
+            rec_types=list(rec_types),
+            clabel=clabel,
+            pclabel=clabel,
+        ),
+    )
+
+
+def create_blockmodel(
+    graph,
+    recs=None,
+    rec_types=None,
+    covars=False,
+    refine=False,
+    n_init: int = 10,
+    n_jobs: int = 1,
+    seeds=None,
+    patience: int = None,
+    max_partitions: int = 1000,
+):
+    """
+    Fits a nested, degree-corrected SBM to `graph`, with the vertex types as
+    labels.
+
+    With `refine="basic"`, the fit is repeated `n_init` times (or once per seed in
+    `seeds`) and the state with the lowest description length is kept. See
+    `fit_nested_blockmodels` for `n_jobs` and `patience`. With
+    `refine="marginals"`, the state is equilibrated with MCMC, and the last
+    `max_partitions` partitions that are sampled are used to find the consensus
+    partition and the vertex marginals (the "pv" vertex property of `state.g`).
+    """
     if covars == True:
         recs = recs
         rec_types = rec_types
@@ -166,33 +431,20 @@ def create_blockmodel(graph, recs=None, rec_types=None, covars=False, refine=Fal
         rec_types = []
 
     if refine == "basic":
-        states = [
-            gt.minimize_nested_blockmodel_dl(
-                graph,
-                state_args=dict(
-                    deg_corr=True,
-                    recs=recs,
-                    rec_types=rec_types,
-                    clabel=clabel,
-                    pclabel=clabel,
-                ),
-            )
-            for n in range(10)
-        ]
-        state = states[np.argmin([s.entropy() for s in states])]
-    else:
-        state = gt.minimize_nested_blockmodel_dl(
-            graph,
-            state_args=dict(
-                deg_corr=True,
-                recs=recs,
-                rec_types=rec_types,
-                clabel=clabel,
-                pclabel=clabel,
-            ),
+        seeds = range(n_init) if seeds is None else seeds
+        state = fit_nested_blockmodels(
+            graph, seeds, recs, rec_types, n_jobs=n_jobs, patience=patience
         )
+    else:
+        state = _minimize_nested_blockmodel(graph, None, recs, rec_types)
 
     if refine == "marginals":
+        # a local, bounded collector instead of a module-level list
+        partitions = deque(maxlen=max_partitions)
+
+        def collect_partitions(s):
+            partitions.append(s.get_bs())
+
         gt.mcmc_equilibrate(
             state,
             force_niter=2000,
@@ -200,9 +452,9 @@ def create_blockmodel(graph, recs=None, rec_types=None, covars=False, refine=Fal
             callback=collect_partitions,
         )
 
-        pmode = gt.PartitionModeState(bs, nested=True, converge=True)
-        pv = pmode.get_marginal(graph)
-        graph.vertex_properties["pv"] = pv
+        pmode = gt.PartitionModeState(list(partitions), nested=True, converge=True)
+        pv = pmode.get_marginal(state.g)
+        state.g.vertex_properties["pv"] = pv
 
         bs = pmode.get_max_nested()
         state = state.copy(bs=bs)
@@ -1,9 +1,22 @@
+import os
+import json
+import glob
+import shutil
+import logging
+import itertools
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 import urllib3
 urllib3.disable_warnings()
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import scan
-from podlm.utilities import merge_string_columns, to_POSIX, from_POSIX
+from podlm.utilities import merge_string_columns, to_POSIX, from_POSIX, apply_dtype_policy
 
 """ OLD...
 def es_query_reddit(search: str, es: Elasticsearch):
@@ -28,12 +41,14 @@ def es_query_reddit(search: str, es: Elasticsearch):
     return results['subs'], results['coms']
 """
 
-def es_query_reddit(search: str, es: Elasticsearch):
+def es_query_reddit(search: str, es: Elasticsearch, project: bool = False):
     results = {}
     query = {'query': {'match': {'subreddit': search}}}
     reddit_indexes = ['reddit-index-s', 'reddit-index-c']
     for ri in reddit_indexes:
-        search_results = scan(es, query = query, index=ri)
+        # with project=True, ES only sends the fields the pipeline uses (see REDDIT_FIELDS)
+        ri_query = es_project_query(query, ri) if project else query
+        search_results = scan(es, query = ri_query, index=ri)
         df = es_results_to_df(search_results)
 
         # FIX: Rename _id to id before dropping other columns
@@ -58,7 +73,7 @@ def es_query_reddit(search: str, es: Elasticsearch):
     return results['subs'], results['coms']
 
 # NEW (roughly 3x faster)
-def es_results_to_df(search_results):
+def es_results_to_df(search_results, arrow_dtypes: bool = False):
     df = pd.json_normalize(data = search_results)
     df.columns = [col.split(".")[-1] for col in df.columns]
     df['created_utc'] = df['created_utc'].astype(int)
@@ -68,6 +83,9 @@ def es_results_to_df(search_results):
     for col in id_columns:
         df[col] = df[col].astype(str)
 
+    if arrow_dtypes:
+        # Arrow-backed strings for text/ids, categories for author/subreddit/domain
+        apply_dtype_policy(df)
     return df
 
 
@@ -89,13 +107,659 @@ def process_datetimes(df: pd.DataFrame):
     return df
 
 
-def sample_discussions(subs: pd.DataFrame, coms: pd.DataFrame, n: int):
+### STREAMING INGEST
+
+# Fields kept from each index. Every chunk of hits is normalized to exactly
+# these columns and types, so the chunks can be appended to one dataset.
+REDDIT_FIELDS = {
+    'reddit-index-s': {
+        'author': pa.string(),
+        'id': pa.string(),
+        'created_utc': pa.int64(),
+        'title': pa.string(),
+        'selftext': pa.string(),
+        'score': pa.int64(),
+        'num_comments': pa.int64(),
+        'url': pa.string(),
+        'domain': pa.string(),
+        'subreddit': pa.string(),
+        'subreddit_type': pa.string(),
+        'gilded': pa.bool_(),
+    },
+    'reddit-index-c': {
+        'author': pa.string(),
+        'id': pa.string(),
+        'parent_id': pa.string(),
+        'link_id': pa.string(),
+        'created_utc': pa.int64(),
+        'body': pa.string(),
+        'score': pa.int64(),
+        'subreddit': pa.string(),
+        'subreddit_type': pa.string(),
+        'is_submitter': pa.bool_(),
+        'gilded': pa.bool_(),
+    },
+}
+
+REDDIT_ID_PREFIXES = {'reddit-index-s': 't3_', 'reddit-index-c': 't1_'}
+
+REDDIT_KINDS = {'reddit-index-s': 'submissions', 'reddit-index-c': 'comments'}
+
+YMD_PARTITIONING = ds.partitioning(pa.schema([('ymd', pa.string())]), flavor='hive')
+
+# scan returns hits in no particular order, so one chunk can cover every day in the
+# index. pyarrow's defaults (1024 partitions per batch, 1024 open files) would fail,
+# or split the days into many small files. The open files also count towards the
+# process limit (ulimit -n).
+DATASET_MAX_PARTITIONS = 100000
+DATASET_MAX_OPEN_FILES = 4096
+
+
+def reddit_schema(fields: dict) -> pa.Schema:
+    schema = [(name, dtype) for name, dtype in fields.items() if name != 'created_utc']
+    schema += [('datetime', pa.timestamp('s', tz='UTC')), ('ymd', pa.string())]
+    return pa.schema(schema)
+
+
+def es_project_query(query: dict, index: str) -> dict:
+    """
+    Asks ES to only return the `_source` fields in REDDIT_FIELDS for `index`,
+    instead of the full documents.
+    """
+    return dict(query, _source=list(REDDIT_FIELDS[index]))
+
+
+def es_field_to_array(values: list, dtype: pa.DataType) -> pa.Array:
+    if pa.types.is_string(dtype):
+        values = [None if v is None else str(v) for v in values]
+    try:
+        return pa.array(values, from_pandas=True).cast(dtype, safe=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # mixed types (e.g. created_utc as int and str), go through strings
+        values = [None if v is None else str(v) for v in values]
+        return pa.array(values).cast(dtype, safe=False)
+
+
+def es_hits_to_table(hits: list, fields: dict, id_prefix: str = '') -> pa.Table:
+    """
+    Normalizes a list of ES hits into an Arrow table with exactly the columns
+    in `fields` (missing fields are null), plus `datetime` and `ymd` columns
+    computed from `created_utc` (which is dropped, as in process_datetimes).
+    """
+    sources = [hit['_source'] for hit in hits]
+    columns = {}
+    for name, dtype in fields.items():
+        if name == 'id':
+            values = [id_prefix + str(hit['_id']) for hit in hits]
+        else:
+            values = [source.get(name) for source in sources]
+        columns[name] = es_field_to_array(values, dtype)
+    created = columns.pop('created_utc').cast(pa.timestamp('s', tz='UTC'))
+    columns['datetime'] = created
+    columns['ymd'] = pc.strftime(created, format='%Y-%m-%d')
+    table = pa.table(columns, schema=reddit_schema(fields))
+    return table.filter(pc.is_valid(created))
+
+
+def write_hits_to_dataset(hits, path: str, fields: dict, id_prefix: str = '',
+                          chunk_size: int = 10000,
+                          basename_template: str = 'part-{i}.parquet',
+                          exclude_ids: pa.Array = None):
+    """
+    Pulls `chunk_size` hits at a time from any iterable of ES hits (e.g. `scan`, or
+    recorded responses in a test) and appends them to a parquet dataset at `path`,
+    partitioned by `ymd`. Only one chunk is held in memory at a time. Hits whose
+    (prefixed) id is in `exclude_ids` are skipped. Returns the number of rows written.
+    """
+    hits = iter(hits)
+    n_rows = [0]
+
+    def batches():
+        while True:
+            chunk = list(itertools.islice(hits, chunk_size))
+            if len(chunk) == 0:
+                return
+            table = es_hits_to_table(chunk, fields, id_prefix)
+            if exclude_ids is not None and len(exclude_ids) > 0:
+                table = table.filter(pc.invert(pc.is_in(table['id'], value_set=exclude_ids)))
+            n_rows[0] += table.num_rows
+            for batch in table.to_batches():
+                yield batch
+
+    schema = reddit_schema(fields)
+    ds.write_dataset(
+        batches(),
+        path,
+        schema=schema,
+        format='parquet',
+        partitioning=YMD_PARTITIONING,
+        basename_template=basename_template,
+        existing_data_behavior='overwrite_or_ignore',
+        max_partitions=DATASET_MAX_PARTITIONS,
+        max_open_files=DATASET_MAX_OPEN_FILES,
+        file_options=ds.ParquetFileFormat().make_write_options(compression='gzip'),
+    )
+    return n_rows[0]
+
+
+def slice_files(path: str, slice_id: int, run_id: str = '') -> list:
+    return glob.glob(os.path.join(path, '*', f'part-{run_id}{slice_id}-*.parquet'))
+
+
+def remove_slice_files(path: str, slice_id: int, run_id: str = ''):
+    for filename in slice_files(path, slice_id, run_id):
+        os.remove(filename)
+
+
+def compact_files(filenames: list):
+    """
+    Rewrites each parquet file that has more than one row group as a single row
+    group. Hits come in no particular date order, so every chunk adds a few rows
+    to every day, and the files end up with many tiny row groups. Only one file
+    (one day of one slice) is in memory at a time. The new file is written next to
+    the old one under a hidden name, so a crash never leaves a partial file in the
+    dataset.
+    """
+    for filename in filenames:
+        if pq.ParquetFile(filename).num_row_groups <= 1:
+            continue
+        table = pq.read_table(filename, partitioning=None)
+        directory, basename = os.path.split(filename)
+        tmp = os.path.join(directory, f'.{basename}.tmp')
+        pq.write_table(table, tmp, compression='gzip', row_group_size=max(table.num_rows, 1))
+        os.replace(tmp, filename)
+
+
+def es_scan_to_dataset(query: dict, es: Elasticsearch, path: str,
+                       index: str = 'reddit-index-s', chunk_size: int = 10000,
+                       slice_id: int = 0, n_slices: int = 1, retries: int = 0,
+                       run_id: str = '', exclude_ids: pa.Array = None):
+    """
+    Runs one scroll over `index`, or one slice of a sliced scroll if `n_slices` > 1,
+    and appends the hits to the parquet dataset at `path`. Each slice writes its
+    own files (prefixed with `run_id`, so appends never overwrite earlier runs),
+    and several slices can write to the same dataset at once. Once the scroll is
+    done, each file is compacted into one row group (see `compact_files`). If a
+    slice fails, its files are removed and it is retried up to `retries` times.
+    Returns the number of rows written.
+    """
+    query = es_project_query(query, index)
+    if n_slices > 1:
+        query = dict(query, slice={'id': slice_id, 'max': n_slices})
+    for attempt in range(retries + 1):
+        try:
+            hits = scan(es, query=query, index=index, size=min(chunk_size, 10000))
+            n_rows = write_hits_to_dataset(
+                hits, path, REDDIT_FIELDS[index], REDDIT_ID_PREFIXES[index],
+                chunk_size, basename_template=f'part-{run_id}{slice_id}-{{i}}.parquet',
+                exclude_ids=exclude_ids)
+            compact_files(slice_files(path, slice_id, run_id))
+            return n_rows
+        except Exception as error:
+            remove_slice_files(path, slice_id, run_id)
+            if attempt == retries:
+                raise
+            logging.warning(f'Retrying slice {slice_id}/{n_slices} of {index} at {path}: {error}')
+
+
+def es_stream_reddit_to_parquet(search: str, es: Elasticsearch, path: str,
+                                index: str = 'reddit-index-s',
+                                chunk_size: int = 10000):
+    """
+    Streams every document for subreddit `search` in `index` into a parquet dataset
+    at `path` partitioned by `ymd`, replacing any dataset already there. Memory use
+    is bounded by `chunk_size`, no matter how big the subreddit is.
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    query = {'query': {'match': {'subreddit': search}}}
+    return es_scan_to_dataset(query, es, path, index, chunk_size)
+
+
+def load_watermarks(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def save_watermarks(watermarks: dict, path: str):
+    with open(path, 'w') as file:
+        json.dump(watermarks, file, indent=2, sort_keys=True)
+
+
+def dataset_watermark(path: str, since: int = None):
+    """
+    Returns the latest `created_utc` (epoch seconds) in the dataset at `path`,
+    only reading the `ymd` partitions on or after `since`. None if there is no data.
+    """
+    if not os.path.exists(path):
+        return None
+    dataset = ds.dataset(path, format='parquet', partitioning=YMD_PARTITIONING)
+    dt = dataset.to_table(columns=['datetime'], filter=ymd_filter(since))['datetime']
+    latest = pc.max(dt.cast(pa.timestamp('s', tz='UTC')).cast(pa.int64())).as_py()
+    return latest
+
+
+def ymd_filter(since: int = None):
+    if since is None:
+        return None
+    return ds.field('ymd') >= from_POSIX(since).strftime('%Y-%m-%d')
+
+
+def es_construct_incremental_query(search: str, since: int) -> dict:
+    return {'query': {'bool': {
+        'must': [{'match': {'subreddit': search}}],
+        'filter': [{'range': {'created_utc': {'gte': since, 'format': 'epoch_second'}}}],
+    }}}
+
+
+def es_parallel_stream_reddit_to_parquet(searches: list, es: Elasticsearch,
+                                         output_dir: str = '../output',
+                                         n_slices: int = 2, max_workers: int = 4,
+                                         chunk_size: int = 10000, retries: int = 2,
+                                         watermarks_path: str = None,
+                                         lookback: int = 86400, indices: list = None):
+    """
+    Does what es_stream_reddit_to_parquet does for every subreddit in `searches`
+    and both indices at the same time. Each scroll is split into `n_slices`
+    sliced scrolls and all slices share a pool of `max_workers` threads.
+    Datasets are written to `{output_dir}/{search}_submissions` and
+    `{output_dir}/{search}_comments`. Returns {(search, index): rows written}.
+
+    If `watermarks_path` is given, the ingest is incremental. The latest
+    `created_utc` of each subreddit and index is kept in that JSON file. Only
+    documents created after that point (minus `lookback` seconds, to catch
+    documents indexed late) are fetched. They are deduped by id against the
+    existing data and appended to the existing datasets. Subreddits without a
+    watermark or dataset are fetched in full.
+
+    `indices` limits the fetch to some of the indices in REDDIT_KINDS.
+    """
+    kinds = {index: REDDIT_KINDS[index] for index in (indices or REDDIT_KINDS)}
+    incremental = watermarks_path is not None
+    watermarks = load_watermarks(watermarks_path) if incremental else {}
+    run_id = datetime.utcnow().strftime('%Y%m%dT%H%M%S-') if incremental else ''
+    jobs, since = [], {}
+    for search in searches:
+        for index, kind in kinds.items():
+            path = os.path.join(output_dir, f'{search}_{kind}')
+            mark = watermarks.get(search, {}).get(index)
+            query, exclude_ids = {'query': {'match': {'subreddit': search}}}, None
+            if mark is not None and os.path.exists(path):
+                since[(search, index)] = mark - lookback
+                query = es_construct_incremental_query(search, mark - lookback)
+                dataset = ds.dataset(path, format='parquet', partitioning=YMD_PARTITIONING)
+                exclude_ids = dataset.to_table(
+                    columns=['id'], filter=ymd_filter(mark - lookback))['id']
+                exclude_ids = pc.unique(exclude_ids.combine_chunks())
+            elif os.path.exists(path):
+                shutil.rmtree(path)
+            for slice_id in range(n_slices):
+                jobs.append((search, index, query, path, slice_id, exclude_ids))
+
+    counts = {(search, index): 0 for search in searches for index in kinds}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(es_scan_to_dataset, query, es, path, index, chunk_size,
+                        slice_id, n_slices, retries, run_id, exclude_ids): (search, index)
+            for search, index, query, path, slice_id, exclude_ids in jobs
+        }
+        for future in as_completed(futures):
+            counts[futures[future]] += future.result()
+
+    if incremental:
+        for search in searches:
+            for index, kind in kinds.items():
+                path = os.path.join(output_dir, f'{search}_{kind}')
+                marks = [watermarks.get(search, {}).get(index),
+                         dataset_watermark(path, since.get((search, index)))]
+                marks = [mark for mark in marks if mark is not None]
+                if len(marks) > 0:
+                    watermarks.setdefault(search, {})[index] = max(marks)
+        save_watermarks(watermarks, watermarks_path)
+    return counts
+
+
+def sample_dataset_ids(path: str, n: int, random_state: int = 42) -> list:
+    """
+    Samples up to `n` ids from the dataset at `path`, reading only the id column.
+    """
+    dataset = ds.dataset(path, format='parquet', partitioning=YMD_PARTITIONING)
+    ids = dataset.to_table(columns=['id'])['id'].to_pandas()
+    return ids.sample(n=min(n, len(ids)), random_state=random_state).tolist()
+
+
+def filter_dataset_by_ids(path: str, ids: list):
+    """
+    Rewrites the dataset at `path` so it only keeps the rows whose id is in `ids`.
+    """
+    dataset = ds.dataset(path, format='parquet', partitioning=YMD_PARTITIONING)
+    table = dataset.to_table(filter=ds.field('id').isin(pa.array(ids, pa.string())))
+    shutil.rmtree(path)
+    os.makedirs(path)
+    ds.write_dataset(
+        table,
+        path,
+        format='parquet',
+        partitioning=YMD_PARTITIONING,
+        max_partitions=DATASET_MAX_PARTITIONS,
+        max_open_files=DATASET_MAX_OPEN_FILES,
+        file_options=ds.ParquetFileFormat().make_write_options(compression='gzip'),
+    )
+    compact_files(glob.glob(os.path.join(path, '*', '*.parquet')))
+
+
+def es_stream_comments_for_submissions(search: str, es: Elasticsearch,
+                                       submission_ids: list, path: str,
+                                       field: str = 'parent_id',
+                                       terms_batch_size: int = 10000,
+                                       max_workers: int = 4, chunk_size: int = 10000,
+                                       retries: int = 2) -> int:
+    """
+    Streams only the comments of the given submissions into a parquet dataset at
+    `path` (replacing it), with `terms` queries on `field` that ES evaluates
+    server-side. With `field='parent_id'` (the default) you get the direct replies
+    to each submission, like sample_discussions does. Ids are sent in batches of
+    `terms_batch_size`, below ES's max_terms_count. Returns the rows written.
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    index = 'reddit-index-c'
+    queries = []
+    for start in range(0, len(submission_ids), terms_batch_size):
+        batch = list(submission_ids[start:start + terms_batch_size])
+        queries.append({'query': {'bool': {
+            'must': [{'match': {'subreddit': search}}],
+            'filter': [{'terms': {field: batch}}],
+        }}})
+    n_rows = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # the batch number doubles as the slice id, so every batch writes its own files
+        futures = [pool.submit(es_scan_to_dataset, query, es, path, index, chunk_size,
+                               batch, 1, retries) for batch, query in enumerate(queries)]
+        for future in as_completed(futures):
+            n_rows += future.result()
+    return n_rows
+
+
+def load_reddit_dataset(path: str, **kwargs) -> pd.DataFrame:
+    """
+    Loads a dataset written by es_stream_reddit_to_parquet into the same shape as
+    the frames returned by es_query_reddit (categorical subreddit_type, tidx index).
+    Extra keyword arguments are passed to pd.read_parquet.
+    """
+    df = pd.read_parquet(path, **kwargs)
+    df['ymd'] = df['ymd'].astype(str)
+    df = set_dtypes(df)
+    df['tidx'] = pd.DatetimeIndex(df['ymd'])
+    df.set_index('tidx', inplace=True)
+    return df
+
+
+def build_conversation_index(subs: pd.DataFrame, coms: pd.DataFrame) -> dict:
+    """
+    Builds an index of the reply trees in `subs` and `coms`. All t3_ (submission)
+    and t1_ (comment) ids are coded as integers, and for every post we store the
+    code of its parent, of the submission at the root of its thread, and its depth
+    (0 for submissions, 1 for direct replies, ...).
+
+    Roots and depths are found by pointer jumping: every post points at its
+    parent, and each pass replaces that pointer with the pointer's pointer and adds
+    up the hops. So the whole index takes O(log(max depth)) vectorized passes.
+
+    When a comment's parent isn't in `coms` (deleted, or not fetched), the chain
+    is broken. Its root then comes from its link_id (if that submission is in
+    `subs`) and its depth is -1. Comments whose thread is unknown get root -1.
+    """
+    ids = pd.Index(pd.unique(np.concatenate([subs['id'].to_numpy(), coms['id'].to_numpy()])))
+    n = len(ids)
+    sub_codes = ids.get_indexer(subs['id'])
+    com_codes = ids.get_indexer(coms['id'])
+    parent = np.full(n, -1, dtype='int64')
+    parent[com_codes] = ids.get_indexer(coms['parent_id'])
+    is_submission = np.zeros(n, dtype=bool)
+    is_submission[sub_codes] = True
+    parent[sub_codes] = -1
+
+    # submissions and comments with a broken chain point at themselves
+    up = np.where(parent >= 0, parent, np.arange(n))
+    hops = (parent >= 0).astype('int64')
+    for _ in range(int(np.ceil(np.log2(max(n, 2)))) + 1):
+        jumped = up[up]
+        if (jumped == up).all():
+            break
+        hops = hops + hops[up]
+        up = jumped
+    done = up[up] == up
+    in_thread = done & is_submission[up]
+    root = np.where(in_thread, up, -1)
+    depth = np.where(in_thread, hops, -1)
+
+    # broken chains: fall back to link_id for the root
+    if 'link_id' in coms.columns:
+        links = np.full(n, -1, dtype='int64')
+        links[com_codes] = ids.get_indexer(coms['link_id'])
+        links = np.where((links >= 0) & is_submission[np.maximum(links, 0)], links, -1)
+        root = np.where(root >= 0, root, links)
+
+    return {
+        'ids': ids,
+        'parent': parent.astype('int32'),
+        'root': root.astype('int32'),
+        'depth': depth.astype('int32'),
+        'is_submission': is_submission,
+    }
+
+
+def conversation_roots(index: dict, ids) -> np.ndarray:
+    """
+    Returns the root submission id of each of `ids`, or None if it's unknown.
+    """
+    codes = index['ids'].get_indexer(pd.Series(ids))
+    root = np.where(codes >= 0, index['root'][np.maximum(codes, 0)], -1)
+    roots = np.full(len(root), None, dtype=object)
+    roots[root >= 0] = index['ids'][root[root >= 0]]
+    return roots
+
+
+def conversation_stats(index: dict, authors=None) -> pd.DataFrame:
+    """
+    Thread-level aggregates, one row per submission: the number of comments in its
+    thread and the depth of the deepest one. If `authors` (aligned with
+    `index['ids']`, see `index_authors`) are passed, the number of distinct
+    authors in the thread (including the submitter) is added too.
+    """
+    subs = np.flatnonzero(index['is_submission'])
+    in_thread = (index['root'] >= 0) & ~index['is_submission']
+    roots = index['root'][in_thread]
+    n_comments = np.bincount(roots, minlength=len(index['ids']))
+    max_depth = np.zeros(len(index['ids']), dtype='int32')
+    np.maximum.at(max_depth, roots, index['depth'][in_thread])
+    stats = pd.DataFrame({
+        'id': index['ids'][subs],
+        'n_comments': n_comments[subs],
+        'max_depth': max_depth[subs],
+    })
+    if authors is not None:
+        codes, _ = pd.factorize(authors)
+        members = (index['root'] >= 0) & (codes >= 0)
+        pairs = np.unique(np.column_stack([index['root'][members], codes[members]]), axis=0)
+        stats['n_authors'] = np.bincount(pairs[:, 0], minlength=len(index['ids']))[subs]
+    return stats
+
+
+def index_authors(index: dict, subs: pd.DataFrame, coms: pd.DataFrame) -> np.ndarray:
+    """
+    The author of every post in the index, aligned with `index['ids']`.
+    """
+    authors = np.full(len(index['ids']), None, dtype=object)
+    for df in [subs, coms]:
+        authors[index['ids'].get_indexer(df['id'])] = df['author'].to_numpy()
+    return authors
+
+
+def reply_author_edges(index: dict, authors: np.ndarray) -> pd.DataFrame:
+    """
+    One row per comment whose parent is known: the comment id, its author, the
+    author of the post it replies to, its root submission and its depth.
+    """
+    rows = np.flatnonzero(index['parent'] >= 0)
+    parents = index['parent'][rows]
+    return pd.DataFrame({
+        'id': index['ids'][rows],
+        'author': authors[rows],
+        'parent_author': authors[parents],
+        'root_id': conversation_roots(index, index['ids'][rows]),
+        'depth': index['depth'][rows],
+    })
+
+
+def sample_discussions(subs: pd.DataFrame, coms: pd.DataFrame, n: int,
+                       full_threads: bool = False):
+    """
+    Samples `n` submissions and their comments. By default, only the direct
+    replies to the sampled submissions are kept. With `full_threads=True`, every
+    comment whose thread (see `build_conversation_index`) is rooted in a sampled
+    submission is kept, at any depth.
+    """
     subs = subs.sample(n=n, random_state=42)
     sampled_sub_ids = subs['id'].to_list()
-    coms = coms[coms['parent_id'].isin(sampled_sub_ids)]
+    if full_threads:
+        index = build_conversation_index(subs, coms)
+        roots = index['root'][index['ids'].get_indexer(coms['id'])]
+        coms = coms[roots >= 0]
+    else:
+        coms = coms[coms['parent_id'].isin(sampled_sub_ids)]
     return subs, coms
     
     
+# thread size bins (number of comments) used to stratify submissions by thread size
+THREAD_SIZE_BINS = [0, 1, 10, 100, 1000]
+
+TIME_STRATA = {'year': 'datetime64[Y]', 'month': 'datetime64[M]',
+               'week': 'datetime64[W]', 'day': 'datetime64[D]'}
+
+
+def hash_ids(ids, seed: int = 42) -> np.ndarray:
+    """
+    Deterministic pseudo-random uint64 per id. The same id and seed always give
+    the same value, on any machine and no matter which other ids are around.
+    """
+    return pd.util.hash_array(np.asarray(ids, dtype=object), hash_key=f'{seed:016d}'[-16:])
+
+
+def submission_strata(table: pa.Table, stratify=None, size_bins=THREAD_SIZE_BINS) -> np.ndarray:
+    """
+    Labels each submission in `table` with its stratum, e.g. '2023-10|10-100' for
+    `stratify=['month', 'thread_size']`. Time strata are periods of the `datetime`
+    column, see TIME_STRATA. Thread size strata are bins of `num_comments`.
+    """
+    labels = pd.Series([''] * table.num_rows, dtype=object)
+    for stratum in ([stratify] if isinstance(stratify, str) else stratify or []):
+        if stratum in TIME_STRATA:
+            datetimes = table['datetime'].to_numpy()
+            periods = datetimes.astype(TIME_STRATA[stratum])
+            part = pd.Series(periods.astype(str))
+        elif stratum == 'thread_size':
+            sizes = table['num_comments'].to_numpy(zero_copy_only=False)
+            bins = np.digitize(sizes, size_bins[1:])
+            names = [f'{lo}-{hi}' for lo, hi in zip(size_bins, size_bins[1:])] + [f'{size_bins[-1]}+']
+            part = pd.Series(np.asarray(names, dtype=object)[bins])
+        else:
+            raise ValueError(f"Unknown stratum '{stratum}'. Use 'thread_size' or one of {list(TIME_STRATA)}.")
+        labels = part if (labels == '').all() else labels + '|' + part
+    return labels.to_numpy()
+
+
+def allocate_sample(counts: pd.Series, n: int, allocation: str = 'proportional') -> pd.Series:
+    """
+    Splits a sample of `n` over strata with `counts` rows each. 'proportional'
+    keeps each stratum's share (largest remainders get the leftovers), 'equal'
+    gives every stratum the same number, and strata that are too small give
+    their leftovers to the others.
+    """
+    n = min(n, int(counts.sum()))
+    if allocation == 'proportional':
+        exact = counts / counts.sum() * n
+        quotas = np.floor(exact).astype('int64')
+        leftover = n - int(quotas.sum())
+        quotas[(exact - quotas).sort_values(ascending=False).index[:leftover]] += 1
+        return quotas
+    if allocation == 'equal':
+        quotas, remaining = pd.Series(0, index=counts.index), n
+        for i, (stratum, count) in enumerate(counts.sort_values().items()):
+            quotas[stratum] = min(count, remaining // (len(counts) - i))
+            remaining -= quotas[stratum]
+        return quotas
+    raise ValueError(f"Unknown allocation '{allocation}'. Use 'proportional' or 'equal'.")
+
+
+def stratified_sample_ids(path: str, n: int, stratify=None, size_bins=THREAD_SIZE_BINS,
+                          allocation: str = 'proportional', seed: int = 42,
+                          batch_size: int = 100000) -> pd.DataFrame:
+    """
+    Samples `n` submission ids from the dataset at `path` in one streaming pass,
+    reading only the columns the strata need, so memory is bounded by the sample
+    rather than the dataset.
+
+    Every id gets a deterministic hash (see `hash_ids`). A uniform sample of a
+    stratum is then just its ids with the smallest hashes. While streaming, only
+    the `n` smallest per stratum (and the stratum sizes) are kept, which is
+    enough for any allocation. The sample is reproducible for the same seed,
+    and it is stable: a larger `n`, or new data that doesn't displace them,
+    keeps the ids that were sampled before.
+    """
+    strata = [stratify] if isinstance(stratify, str) else list(stratify or [])
+    columns = ['id'] + (['datetime'] if set(strata) & set(TIME_STRATA) else [])
+    columns += ['num_comments'] if 'thread_size' in strata else []
+    dataset = ds.dataset(path, format='parquet', partitioning=YMD_PARTITIONING)
+    kept, counts = None, pd.Series(dtype='int64')
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        table = pa.Table.from_batches([batch])
+        ids = table['id'].to_numpy(zero_copy_only=False)
+        candidates = pd.DataFrame({
+            'id': ids,
+            'stratum': submission_strata(table, strata, size_bins),
+            'hash': hash_ids(ids, seed),
+        })
+        counts = counts.add(candidates['stratum'].value_counts(), fill_value=0)
+        kept = candidates if kept is None else pd.concat([kept, candidates])
+        kept = kept.sort_values(['stratum', 'hash']).groupby('stratum').head(n)
+    if kept is None:
+        return pd.DataFrame({'id': [], 'stratum': []})
+    quotas = allocate_sample(counts.astype('int64'), n, allocation)
+    rank = kept.groupby('stratum').cumcount()
+    sample = kept[rank.to_numpy() < quotas.reindex(kept['stratum']).to_numpy()]
+    return sample[['id', 'stratum']].reset_index(drop=True)
+
+
+def sample_discussions_from_datasets(subs_path: str, coms_path: str, n: int,
+                                     stratify=None, size_bins=THREAD_SIZE_BINS,
+                                     allocation: str = 'proportional',
+                                     full_threads: bool = False, seed: int = 42):
+    """
+    Like `sample_discussions`, but straight from the parquet datasets, without
+    loading either of them in full. Submissions are sampled with
+    `stratified_sample_ids`. Only their rows are read, and only the comments of
+    the sampled threads are read from the comments dataset: by parent_id (direct
+    replies) or by link_id (`full_threads`). The ids are pushed down to pyarrow as
+    a filter, together with a ymd filter that skips the partitions from before
+    the oldest sampled submission.
+    """
+    sample = stratified_sample_ids(subs_path, n, stratify, size_bins, allocation, seed)
+    ids = sample['id'].tolist()
+    if len(ids) == 0:
+        raise ValueError(f'There are no submissions to sample in {subs_path}.')
+    subs = load_reddit_dataset(subs_path, filters=[('id', 'in', ids)])
+    field = 'link_id' if full_threads else 'parent_id'
+    filters = [(field, 'in', ids)]
+    if len(subs) > 0:
+        filters.append(('ymd', '>=', subs['ymd'].min()))
+    coms = load_reddit_dataset(coms_path, filters=filters)
+    return subs, coms
+
+
 def merge_submissions_and_comments(submissions: pd.DataFrame, comments: pd.DataFrame) -> pd.DataFrame:
     submissions = merge_string_columns(submissions, 'selftext', 'title', 'text', drop=True)
     submissions['parent_id'] = submissions['id']
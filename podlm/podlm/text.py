@@ -1,8 +1,11 @@
 from termcolor import colored
-from scipy.special import softmax
 from datetime import datetime
+import itertools
+import numpy as np
 import pandas as pd
 import spacy
+from spacy.matcher import Matcher
+import torch
 from bertopic import BERTopic
 from sentence_transformers import SentenceTransformer, util
 from umap import UMAP
@@ -13,10 +16,46 @@ from bertopic.representation import (
     MaximalMarginalRelevance,
     PartOfSpeech,
 )
+from podlm.utilities import apply_dtype_policy
+
+ROBERTA_BASE_GO_EMOTIONS = [
+    "admiration",
+    "amusement",
+    "anger",
+    "annoyance",
+    "approval",
+    "caring",
+    "confusion",
+    "curiosity",
+    "desire",
+    "disappointment",
+    "disapproval",
+    "disgust",
+    "embarrassment",
+    "excitement",
+    "fear",
+    "gratitude",
+    "grief",
+    "joy",
+    "love",
+    "nervousness",
+    "neutral",
+    "optimism",
+    "pride",
+    "realization",
+    "relief",
+    "remorse",
+    "sadness",
+    "surprise",
+]
 
 
 def split_sentences(
-    df: pd.DataFrame, model, textcol: str = "text", idcol: str = "id"
+    df: pd.DataFrame,
+    model,
+    textcol: str = "text",
+    idcol: str = "id",
+    arrow_dtypes: bool = False,
 ) -> pd.DataFrame:
     sentences = []
     texts = df[textcol].replace(r"\n", " ", regex=True)
@@ -28,6 +67,8 @@ def split_sentences(
                 id_sentence = str(post_id) + "_" + str(i_sent)
                 sentences.append({"id_sentence": id_sentence, "sentence": sent.text})
     sentences = pd.DataFrame(sentences)
+    if arrow_dtypes:
+        apply_dtype_policy(sentences)
     return sentences
 
 
@@ -35,35 +76,144 @@ def count_categorical(
     df: pd.DataFrame, id_col: str, cat_col: str, score_threshold: float
 ) -> pd.DataFrame:
     df = df[df["score"] > score_threshold]
-    grouped = df.groupby([id_col, cat_col])
-    counts = grouped.size().reset_index(name="count")
-    pivoted = counts.pivot(index=id_col, columns=cat_col, values="count")
-    pivoted = pivoted.fillna(0)
-    pivoted = pivoted.reset_index()
+    ids, id_values = pd.factorize(df[id_col], sort=True)
+    cats, cat_values = pd.factorize(df[cat_col], sort=True)
+    counts = np.bincount(
+        ids * len(cat_values) + cats, minlength=len(id_values) * len(cat_values)
+    )
+    counts = counts.reshape(len(id_values), len(cat_values))
+    pivoted = pd.DataFrame(counts, columns=cat_values)
+    pivoted.insert(0, id_col, id_values)
     return pivoted
 
 
+def model_name(model) -> str:
+    """
+    The HF hub name (or local path) a model was loaded from, for HF models,
+    pipelines, SpanMarker and SentenceTransformer models.
+    """
+    if isinstance(model, str):
+        return model
+    inner = getattr(model, "model", model)  # HF pipelines wrap the model
+    name = getattr(getattr(inner, "config", None), "_name_or_path", None)
+    if not name and isinstance(model, SentenceTransformer):
+        name = getattr(model[0].auto_model.config, "_name_or_path", None)
+    return name or type(model).__name__
+
+
+def cached_predictions(texts: list, predict, cache=None, model_id: str = None) -> list:
+    """
+    Returns one prediction per text, like `predict(texts)` would, but only runs
+    `predict` on the unique texts that aren't in the `cache` (a
+    `podlm.utilities.InferenceCache`) yet, and stores its results. Predictions
+    that are None mark failures and are not cached.
+    """
+    if cache is None:
+        return list(predict(texts))
+    values = cache.get_many(model_id, texts)
+    missing = list(dict.fromkeys(t for t, v in zip(texts, values) if v is None))
+    if len(missing) > 0:
+        new = dict(zip(missing, predict(missing)))
+        done = [t for t in missing if new[t] is not None and isinstance(t, str)]
+        cache.put_many(model_id, done, [new[t] for t in done])
+        values = [new[t] if v is None else v for t, v in zip(texts, values)]
+    return values
+
+
+def encode_sentences(
+    texts: list,
+    model,
+    out=None,
+    batch_size: int = 64,
+    chunk_size: int = 10000,
+    cache=None,
+) -> np.ndarray:
+    """
+    Encodes `texts` with a SentenceTransformer, `chunk_size` texts at a time, and
+    writes each chunk into `out`. If `out` is a memmap (see
+    `podlm.utilities.create_embedding_store`), only one chunk of embeddings is
+    ever in memory. Without `out`, a float32 array is returned.
+    """
+    if out is None:
+        dim = model.get_sentence_embedding_dimension()
+        out = np.zeros((len(texts), dim), dtype="float32")
+    model_id = f"{model_name(model)}:embeddings" if cache is not None else None
+
+    def encode(ts):
+        return list(model.encode(ts, batch_size=batch_size, convert_to_numpy=True))
+
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts[start : start + chunk_size]
+        out[start : start + len(chunk)] = np.stack(
+            cached_predictions(chunk, encode, cache, model_id)
+        )
+    return out
+
+
+def entity_predictions(texts: list, model, batch_size: int = 32) -> list:
+    """
+    Returns one list of entity dicts per text, or None if SpanMarker failed on it.
+    Texts are passed to `model.predict` as lists of sentences, in length-sorted
+    batches. SpanMarker reads a list of strings without any whitespace as a single
+    pre-tokenized sentence, so those texts are predicted one at a time.
+    """
+    predictions = [None] * len(texts)
+
+    def predict_one(i):
+        try:
+            predictions[i] = model.predict(texts[i])
+        except Exception:
+            pass
+
+    multiword = [isinstance(t, str) and len(t.split()) > 1 for t in texts]
+    multiword = np.array(multiword, dtype=bool)
+    for i in np.flatnonzero(~multiword):
+        predict_one(i)
+    rows = np.flatnonzero(multiword)
+    lengths = [len(texts[i]) for i in rows]
+    for batch in length_sorted_batches(lengths, batch_size):
+        batch = rows[batch]
+        try:
+            entities = model.predict([texts[i] for i in batch], batch_size=batch_size)
+            for i, ents in zip(batch, entities):
+                predictions[i] = ents
+        except Exception:
+            for i in batch:
+                predict_one(i)
+    return predictions
+
+
 def transformer_entities(
     df: pd.DataFrame,
     model,
     entity_score_threshold: float,
     textcol: str = "sentence",
     idcol: str = "id_sentence",
+    batch_size: int = 32,
+    cache=None,
 ):
-    entity_dfs, errors = [], []
-    for i, t in enumerate(df[textcol]):
-        try:
-            entities = model.predict(t)
-            if len(entities) > 0:
-                entdf = pd.DataFrame(entities)
-                entdf["id_sentence"] = df.iloc[i][idcol]
-                entity_dfs.append(entdf)
-        except:
-            errors.append([i, t])
+    texts = df[textcol].tolist()
+    predictions = cached_predictions(
+        texts,
+        lambda ts: entity_predictions(ts, model, batch_size),
+        cache,
+        f"{model_name(model)}:entities",
+    )
+    fields = ["span", "label", "score", "char_start_index", "char_end_index"]
+    columns = {field: [] for field in fields + ["id_sentence"]}
+    errors = []
+    for i, (sentid, entities) in enumerate(zip(df[idcol], predictions)):
+        if entities is None:
+            errors.append([i, texts[i]])
+            continue
+        for entity in entities:
+            for field in fields:
+                columns[field].append(entity[field])
+            columns["id_sentence"].append(sentid)
     if len(errors) > 0:
         for error in errors:
             print(colored(error, "red"))
-    results_long = pd.concat(entity_dfs)
+    results_long = pd.DataFrame(columns)
     # count types above score threshold
     count_types = count_categorical(
         results_long, "id_sentence", "label", score_threshold=entity_score_threshold
@@ -74,21 +224,47 @@ def transformer_entities(
 
 def transformer_topics(
     df: pd.DataFrame,
-    model: str = "all-MiniLM-L6-v2",
+    model="all-MiniLM-L6-v2",
     umap_n_neighbors: int = 15,
     umap_n_components: int = 5,
     hdbscan_min_cluster_size: int = 15,
     mmr_model_diversity: float = 0.3,
     textcol: str = "sentence",
+    cache=None,
+    embeddings=None,
+    fit_sample_size: int = None,
+    transform_batch_size: int = 100000,
+    random_state: int = 30,
 ):
+    """
+    `model` is a SentenceTransformer or the name of one. If `embeddings` (e.g. a
+    memmap from `podlm.utilities.load_embedding_store`) are passed, they must be
+    aligned with the rows of `df`, and the sentences aren't encoded again.
+
+    By default, UMAP and HDBSCAN are fit on all sentences. With `fit_sample_size`,
+    the topic model is fit on a random sample of that many sentences, and the
+    rest are assigned to its topics with `assign_topics`, `transform_batch_size`
+    at a time. Memory use then depends on the sample size, not the corpus size.
+    The counts in `topic_info` always cover all sentences.
+    """
     df = df.reset_index(drop=True)
-    sent_embeddings = SentenceTransformer(model)
-    embeddings = sent_embeddings.encode(df[textcol], show_progress_bar=True)
+    if isinstance(model, str):
+        sent_embeddings = SentenceTransformer(model)
+    else:
+        sent_embeddings = model
+    if embeddings is None:
+        embeddings = encode_sentences(
+            df[textcol].tolist(), sent_embeddings, cache=cache
+        )
     umap_model = UMAP(
-        n_neighbors=15, n_components=5, min_dist=0.0, metric="cosine", random_state=30
+        n_neighbors=umap_n_neighbors,
+        n_components=umap_n_components,
+        min_dist=0.0,
+        metric="cosine",
+        random_state=random_state,
     )
     hdbscan_model = HDBSCAN(
-        min_cluster_size=15,
+        min_cluster_size=hdbscan_min_cluster_size,
         metric="euclidean",
         cluster_selection_method="eom",
         prediction_data=True,
@@ -98,7 +274,7 @@ def transformer_topics(
     )
     keybert_model = KeyBERTInspired()
     # pos_model = PartOfSpeech("en_core_web_sm")
-    mmr_model = MaximalMarginalRelevance(diversity=0.3)
+    mmr_model = MaximalMarginalRelevance(diversity=mmr_model_diversity)
     representation_model = {
         "KeyBERT": keybert_model,
         "MMR": mmr_model,
@@ -112,135 +288,429 @@ def transformer_topics(
         top_n_words=10,
         verbose=True,
     )
-    topics, probabilities = topic_model.fit_transform(df[textcol], embeddings)
+    if fit_sample_size is None or fit_sample_size >= len(df):
+        embeddings = np.asarray(embeddings, dtype="float32")
+        topics, probabilities = topic_model.fit_transform(df[textcol], embeddings)
+    else:
+        rng = np.random.default_rng(random_state)
+        sample = np.sort(rng.choice(len(df), size=fit_sample_size, replace=False))
+        topic_model.fit(
+            df[textcol].iloc[sample].tolist(),
+            np.asarray(embeddings[sample], dtype="float32"),
+        )
+        topics, probabilities = assign_topics(
+            topic_model, df[textcol], embeddings, transform_batch_size
+        )
     df["topic"] = topics
     df["topic_probability"] = probabilities
     topic_info = topic_model.get_topic_info()
+    counts = df["topic"].value_counts()
+    topic_info["Count"] = topic_info["Topic"].map(counts).fillna(0).astype("int64")
     return df, topic_info, topic_model
 
 
+def assign_topics(topic_model, docs, embeddings, batch_size: int = 100000):
+    """
+    Assigns `docs` to the topics of a fitted BERTopic model, `batch_size` at a
+    time. Each batch goes through UMAP's `transform` and HDBSCAN's
+    `approximate_predict` (via `topic_model.transform`), so only one batch of
+    embeddings has to be in memory as float32. Returns the topics and the
+    probability of each assignment.
+    """
+    docs = pd.Series(docs).reset_index(drop=True)
+    topics = np.empty(len(docs), dtype="int64")
+    probabilities = np.full(len(docs), np.nan, dtype="float64")
+    for start in range(0, len(docs), batch_size):
+        end = min(start + batch_size, len(docs))
+        batch_topics, batch_probabilities = topic_model.transform(
+            docs.iloc[start:end].tolist(),
+            np.asarray(embeddings[start:end], dtype="float32"),
+        )
+        topics[start:end] = batch_topics
+        if batch_probabilities is not None:
+            batch_probabilities = np.asarray(batch_probabilities)
+            if batch_probabilities.ndim == 2:
+                batch_probabilities = batch_probabilities.max(axis=1)
+            probabilities[start:end] = batch_probabilities
+    return topics, probabilities
+
+
+def update_topics(
+    df: pd.DataFrame,
+    topic_model,
+    previous: pd.DataFrame,
+    embeddings,
+    textcol: str = "sentence",
+    idcol: str = "id_sentence",
+    transform_batch_size: int = 100000,
+    merge_new: bool = False,
+    merge_min_size: int = 1000,
+    min_similarity: float = 0.7,
+    embedding_model=None,
+    **topic_params,
+):
+    """
+    Incremental version of `transformer_topics`. Sentences that are already in
+    `previous` (the topics frame of an earlier run) keep their topics, and only
+    the new ones are assigned to the topics of the fitted `topic_model`, so the
+    cost scales with the new data. `embeddings` must be aligned with `df`, and
+    only the rows of new sentences are read.
+
+    A model loaded from safetensors has no UMAP or HDBSCAN, so BERTopic assigns
+    the new sentences to the topic with the most similar topic embedding. For
+    those sentences, `topic_probability` is that cosine similarity.
+
+    With `merge_new`, a model is also fit on the new sentences (with
+    `embedding_model` and `topic_params`, see `transformer_topics`) and merged
+    into `topic_model` with `BERTopic.merge_models` first. That way topics that
+    only show up in new data are picked up. Merging needs BERTopic 0.16+ and at
+    least `merge_min_size` new sentences, otherwise it's skipped.
+
+    Returns the topics frame, the topic info, the (possibly merged) topic model,
+    and the number of new sentences.
+    """
+    df = df.reset_index(drop=True)
+    previous = previous.drop_duplicates(idcol).set_index(idcol)
+    positions = previous.index.get_indexer(df[idcol])
+    old, new = positions >= 0, np.flatnonzero(positions < 0)
+    topics = np.empty(len(df), dtype="int64")
+    probabilities = np.full(len(df), np.nan, dtype="float64")
+    topics[old] = previous["topic"].to_numpy()[positions[old]]
+    probabilities[old] = previous["topic_probability"].to_numpy()[positions[old]]
+    if len(new) > 0:
+        docs = df[textcol].iloc[new]
+        new_embeddings = np.asarray(embeddings[new], dtype="float32")
+        can_merge = hasattr(BERTopic, "merge_models") and len(new) >= merge_min_size
+        if merge_new and can_merge:
+            _, _, new_model = transformer_topics(
+                docs.to_frame(textcol),
+                model=embedding_model,
+                textcol=textcol,
+                embeddings=new_embeddings,
+                **topic_params,
+            )
+            topic_model = BERTopic.merge_models(
+                [topic_model, new_model], min_similarity=min_similarity
+            )
+        topics[new], probabilities[new] = assign_topics(
+            topic_model, docs, new_embeddings, transform_batch_size
+        )
+    df["topic"] = topics
+    df["topic_probability"] = probabilities
+    topic_info = topic_model.get_topic_info()
+    counts = df["topic"].value_counts()
+    topic_info["Count"] = topic_info["Topic"].map(counts).fillna(0).astype("int64")
+    return df, topic_info, topic_model, len(new)
+
+
+def get_torch_device(device=None):
+    if device is not None:
+        return torch.device(device)
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def length_sorted_batches(lengths, batch_size: int):
+    """
+    Yields arrays of row positions, grouping texts of similar length together
+    so that each batch needs as little padding as possible.
+    """
+    order = np.argsort(np.asarray(lengths), kind="stable")
+    for start in range(0, len(order), batch_size):
+        yield order[start : start + batch_size]
+
+
+def sentiment_scores(
+    texts: list,
+    model,
+    tokenizer,
+    batch_size: int = 32,
+    max_length: int = 512,
+) -> np.ndarray:
+    """
+    Returns an (n_texts x n_labels) array of softmax probabilities. Texts are
+    tokenized once, sorted by length, and classified in padded batches on whatever
+    device the model is on. Rows that could not be classified are NaN.
+    """
+    if len(texts) == 0:
+        return np.empty((0, model.config.num_labels), dtype="float32")
+    device = next(model.parameters()).device
+    model.eval()
+    input_ids = tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+    scores = np.full((len(texts), model.config.num_labels), np.nan, dtype="float32")
+
+    def classify(rows):
+        batch = [input_ids[i] for i in rows]
+        batch = tokenizer.pad({"input_ids": batch}, return_tensors="pt")
+        logits = model(**batch.to(device)).logits
+        return torch.softmax(logits.float(), dim=-1).cpu().numpy()
+
+    with torch.inference_mode():
+        for rows in length_sorted_batches([len(x) for x in input_ids], batch_size):
+            try:
+                scores[rows] = classify(rows)
+            except Exception:
+                # fall back to one text at a time so one bad text doesn't sink the batch
+                for i in rows:
+                    try:
+                        scores[i] = classify([i])
+                    except Exception:
+                        pass
+    return scores
+
+
 def transformer_sentiment(
     df: pd.DataFrame,
     model,
     tokenizer,
     textcol: str = "sentence",
     idcol: str = "id_sentence",
+    batch_size: int = 32,
+    max_length: int = 512,
+    cache=None,
 ):
-    scores, errors, sentids = [], [], []
-    for i, t in enumerate(df[textcol]):
-        try:
-            encoded = tokenizer.encode(t, return_tensors="pt")
-            sentsent = model(encoded)
-            sentsent = sentsent[0][0].detach().numpy()
-            sentsent = softmax(sentsent)
-            scores.append(sentsent)
-            sentids.append(df.iloc[i][idcol])
-        except:
-            errors.append([i, t])
-        if len(errors) > 0:
-            for error in errors:
-                print(colored(error, "red"))
-    df = pd.DataFrame(scores)
+    texts = df[textcol].tolist()
+    valid = np.array([isinstance(t, str) for t in texts], dtype=bool)
+    scores = np.full((len(texts), 3), np.nan, dtype="float32")
+    valid_texts = [t for t, v in zip(texts, valid) if v]
+    if cache is None:
+        scores[valid] = sentiment_scores(
+            valid_texts, model, tokenizer, batch_size, max_length
+        )
+    else:
+
+        def predict(ts):
+            rows = sentiment_scores(ts, model, tokenizer, batch_size, max_length)
+            return [None if np.isnan(row).any() else row for row in rows]
+
+        model_id = f"{model_name(model)}:sentiment:{max_length}"
+        rows = cached_predictions(valid_texts, predict, cache, model_id)
+        for i, row in zip(np.flatnonzero(valid), rows):
+            if row is not None:
+                scores[i] = row
+    ok = ~np.isnan(scores).any(axis=1)
+    errors = [[int(i), texts[i]] for i in np.flatnonzero(~ok)]
+    if len(errors) > 0:
+        for error in errors:
+            print(colored(error, "red"))
+    sentids = df[idcol].to_numpy()[ok]
+    df = pd.DataFrame(scores[ok])
     df.columns = ["sentiment_negative", "sentiment_neutral", "sentiment_positive"]
     df["id_sentence"] = sentids
     return df
 
 
+def emotion_concept_scores(
+    texts,
+    model,
+    n_texts: int,
+    batch_size: int = 32,
+    labels=ROBERTA_BASE_GO_EMOTIONS,
+    chunk_size: int = 1024,
+) -> np.ndarray:
+    """
+    Streams `texts` (any iterable, e.g. a generator) through a HF text-classification
+    pipeline, `chunk_size` texts at a time, and writes each score straight into a
+    preallocated float32 array with one column per label, in the order of `labels`.
+    Labels the pipeline doesn't return, e.g. because it was created with a small
+    `top_k`, are left at 0. Rows that could not be classified are NaN.
+    """
+    columns = {label: j for j, label in enumerate(labels)}
+    scores = np.full((n_texts, len(labels)), np.nan, dtype="float32")
+
+    def score_rows(rows, chunk):
+        outputs = model(chunk, batch_size=batch_size, truncation=True)
+        wide = np.zeros((len(rows), len(labels)), dtype="float32")
+        for i, emo in enumerate(outputs):
+            if len(emo) > 0 and isinstance(emo[0], list):
+                emo = emo[0]
+            for e in emo:
+                wide[i, columns[e["label"]]] = e["score"]
+        scores[rows] = wide
+
+    texts = iter(texts)
+    for start in range(0, n_texts, chunk_size):
+        chunk = list(itertools.islice(texts, chunk_size))
+        rows = np.arange(start, start + len(chunk))
+        try:
+            score_rows(rows, chunk)
+        except Exception:
+            # fall back to one text at a time so one bad text doesn't sink the chunk
+            for i, t in zip(rows, chunk):
+                try:
+                    score_rows([i], [t])
+                except Exception:
+                    pass
+    return scores
+
+
 def transformer_emotion_concepts(
     df: pd.DataFrame,
     model,
-    tokenizer,
     textcol: str = "sentence",
     idcol: str = "id_sentence",
+    batch_size: int = 32,
+    cache=None,
 ):
-    errors, sentids = [], []
-    roberta_base_go_emotions = [
-        "admiration",
-        "amusement",
-        "anger",
-        "annoyance",
-        "approval",
-        "caring",
-        "confusion",
-        "curiosity",
-        "desire",
-        "disappointment",
-        "disapproval",
-        "disgust",
-        "embarrassment",
-        "excitement",
-        "fear",
-        "gratitude",
-        "grief",
-        "joy",
-        "love",
-        "nervousness",
-        "neutral",
-        "optimism",
-        "pride",
-        "realization",
-        "relief",
-        "remorse",
-        "sadness",
-        "surprise",
-    ]
-    ec_wide = []
-    for i, t in enumerate(df[textcol]):
-        try:
-            wide = []
-            if len(t) > 512:
-                t = truncate_text_to_transformer_limit(text=t)
-            emo = model(t)[0]
-            for ec in roberta_base_go_emotions:
-                for e in emo:
-                    if e["label"] == ec:
-                        wide.append(e["score"])
-            ec_wide.append(wide)
-            sentids.append(df.iloc[i][idcol])
-        except:
-            errors.append([i, t])
-        if len(errors) > 0:
-            for error in errors:
-                print(colored(error, "red"))
-    df = pd.DataFrame(ec_wide)
-    df.columns = roberta_base_go_emotions
+    texts = df[textcol].tolist()
+    valid = np.array([isinstance(t, str) for t in texts], dtype=bool)
+    scores = np.full((len(texts), len(ROBERTA_BASE_GO_EMOTIONS)), np.nan, "float32")
+    valid_texts = (t for t, v in zip(texts, valid) if v)
+    if cache is None:
+        scores[valid] = emotion_concept_scores(
+            valid_texts, model, int(valid.sum()), batch_size
+        )
+    else:
+
+        def predict(ts):
+            rows = emotion_concept_scores(iter(ts), model, len(ts), batch_size)
+            return [None if np.isnan(row).any() else row for row in rows]
+
+        model_id = f"{model_name(model)}:emotions"
+        rows = cached_predictions(list(valid_texts), predict, cache, model_id)
+        for i, row in zip(np.flatnonzero(valid), rows):
+            if row is not None:
+                scores[i] = row
+    ok = ~np.isnan(scores).any(axis=1)
+    errors = [[int(i), texts[i]] for i in np.flatnonzero(~ok)]
+    if len(errors) > 0:
+        for error in errors:
+            print(colored(error, "red"))
+    sentids = df[idcol].to_numpy()[ok]
+    df = pd.DataFrame(scores[ok], columns=ROBERTA_BASE_GO_EMOTIONS)
     df["id_sentence"] = sentids
     return df
 
 
+PRONOUN_PATTERNS = {
+    "pronoun_first_person": [
+        [{"POS": "PRON", "OP": "+", "MORPH": {"IS_SUPERSET": ["Person=1"]}}]
+    ],
+    "pronoun_second_person": [
+        [{"POS": "PRON", "OP": "+", "MORPH": {"IS_SUPERSET": ["Person=2"]}}]
+    ],
+    "pronoun_third_person": [
+        [{"POS": "PRON", "OP": "+", "MORPH": {"IS_SUPERSET": ["Person=3"]}}]
+    ],
+}
+
+
+def build_feature_matcher(model, patterns: dict = PRONOUN_PATTERNS):
+    """
+    Compiles every pattern into one spaCy Matcher, using the keys of `patterns` as
+    match labels. Build it once per model and reuse it for every doc. To tag more
+    features in the same pass, add to the patterns, e.g.
+
+        past = [{"MORPH": {"IS_SUPERSET": ["Tense=Past"]}}]
+        patterns = {**PRONOUN_PATTERNS, "tense_past": [past]}
+    """
+    matcher = Matcher(model.vocab)
+    for label, label_patterns in patterns.items():
+        matcher.add(label, label_patterns)
+    return matcher
+
+
+def match_features(doclike, matcher, labels) -> list:
+    """
+    Runs `matcher` once over a Doc or Span and returns a list with the matched texts
+    for each label, in the order of `labels`.
+    """
+    found = {label: [] for label in labels}
+    for match in matcher(doclike, as_spans=True):
+        found[match.label_].append(match.text)
+    return [found[label] for label in labels]
+
+
+def linguistic_features_frame(
+    coarse_counts: list, ids: list, matches: list, labels
+) -> pd.DataFrame:
+    coarse_counts = pd.DataFrame(coarse_counts).fillna(0)
+    coarse_counts["id_sentence"] = ids
+    counts = np.zeros((len(matches), len(labels)), dtype="int32")
+    for i, found in enumerate(matches):
+        counts[i] = [len(x) for x in found]
+    for j, label in enumerate(labels):
+        coarse_counts[label] = [found[j] for found in matches]
+    for j, label in enumerate(labels):
+        coarse_counts[f"count_{label}"] = counts[:, j]
+    return coarse_counts
+
+
 def count_parts_of_speech(
-    df: pd.DataFrame, model, textcol: str = "sentence"
+    df: pd.DataFrame,
+    model,
+    textcol: str = "sentence",
+    patterns: dict = PRONOUN_PATTERNS,
 ) -> pd.DataFrame:
-    coarse_counts, ids = [], []
-    pronouns_1, pronouns_2, pronouns_3 = [], [], []
+    coarse_counts, ids, matches = [], [], []
+    labels = list(patterns)
+    matcher = build_feature_matcher(model, patterns)
     docs = model.pipe(df[textcol])
-    for i_doc, doc in enumerate(docs):
-        id_sentence = df.iloc[i_doc]["id_sentence"]
+    for id_sentence, doc in zip(df["id_sentence"], docs):
         ids.append(id_sentence)
         # COARSE POS
         pos_count = doc.count_by(spacy.attrs.POS)
         pos_count = {model.vocab.strings[k]: v for k, v in pos_count.items()}
         coarse_counts.append(pos_count)
         # FINE POS
-        first, second, third = categorize_pronouns(doc, model)
-        pronouns_1.append(first)
-        pronouns_2.append(second)
-        pronouns_3.append(third)
+        matches.append(match_features(doc, matcher, labels))
+    return linguistic_features_frame(coarse_counts, ids, matches, labels)
 
-    coarse_counts = pd.DataFrame(coarse_counts).fillna(0)
-    coarse_counts["id_sentence"] = ids
-    coarse_counts["pronoun_first_person"] = pronouns_1
-    coarse_counts["pronoun_second_person"] = pronouns_2
-    coarse_counts["pronoun_third_person"] = pronouns_3
-    coarse_counts["count_pronoun_first_person"] = [len(x) for x in pronouns_1]
-    coarse_counts["count_pronoun_second_person"] = [len(x) for x in pronouns_2]
-    coarse_counts["count_pronoun_third_person"] = [len(x) for x in pronouns_3]
-    return coarse_counts
 
+def split_sentences_with_linguistic_features(
+    df: pd.DataFrame,
+    model,
+    textcol: str = "text",
+    idcol: str = "id",
+    n_process: int = 1,
+    batch_size: int = 1000,
+    patterns: dict = PRONOUN_PATTERNS,
+    arrow_dtypes: bool = False,
+):
+    """
+    Parses each post once and returns two dataframes: the sentences, as returned by
+    `split_sentences`, and their linguistic features, as returned by
+    `count_parts_of_speech`. The features are computed on the sentence spans of
+    the parsed post instead of re-parsing every sentence on its own, so a few tags
+    can differ from `count_parts_of_speech` because the tagger sees the full post.
+    With `arrow_dtypes`, the sentence ids and texts are Arrow-backed strings (see
+    `apply_dtype_policy`).
+    """
+    sentences, coarse_counts, ids, matches = [], [], [], []
+    labels = list(patterns)
+    matcher = build_feature_matcher(model, patterns)
+    texts = df[textcol].fillna("").replace(r"\n", " ", regex=True)
+    docs = model.pipe(
+        zip(texts, df[idcol]),
+        as_tuples=True,
+        n_process=n_process,
+        batch_size=batch_size,
+    )
+    for doc, post_id in docs:
+        pos = doc.to_array(spacy.attrs.POS)
+        for i_sent, sent in enumerate(doc.sents):
+            if len(sent) > 2:
+                id_sentence = str(post_id) + "_" + str(i_sent)
+                sentences.append({"id_sentence": id_sentence, "sentence": sent.text})
+                ids.append(id_sentence)
+                # COARSE POS
+                values, counts = np.unique(
+                    pos[sent.start : sent.end], return_counts=True
+                )
+                pos_count = {
+                    model.vocab.strings[int(k)]: int(v) for k, v in zip(values, counts)
+                }
+                coarse_counts.append(pos_count)
+                # FINE POS
+                matches.append(match_features(sent, matcher, labels))
+    sentences = pd.DataFrame(sentences)
+    features = linguistic_features_frame(coarse_counts, ids, matches, labels)
+    if arrow_dtypes:
+        apply_dtype_policy(sentences)
+        apply_dtype_policy(features)
+    return sentences, features
 
-def matchy_matchy(doc, pattern, model):
-    from spacy.matcher import Matcher
 
+def matchy_matchy(doc, pattern, model):
     matcher = Matcher(model.vocab)
     matcher.add("pattern", [pattern])
     matches = matcher(doc, as_spans=True)
@@ -248,26 +718,173 @@ def matchy_matchy(doc, pattern, model):
     return matches
 
 
-def categorize_pronouns(doc, model):
-    first = matchy_matchy(
-        doc,
-        [{"POS": "PRON", "OP": "+", "MORPH": {"IS_SUPERSET": [f"Person=1"]}}],
-        model,
-    )
-    second = matchy_matchy(
-        doc,
-        [{"POS": "PRON", "OP": "+", "MORPH": {"IS_SUPERSET": [f"Person=2"]}}],
-        model,
-    )
-    third = matchy_matchy(
-        doc,
-        [{"POS": "PRON", "OP": "+", "MORPH": {"IS_SUPERSET": [f"Person=3"]}}],
-        model,
-    )
+def categorize_pronouns(doc, model, matcher=None):
+    if matcher is None:
+        matcher = build_feature_matcher(model, PRONOUN_PATTERNS)
+    first, second, third = match_features(doc, matcher, list(PRONOUN_PATTERNS))
     return first, second, third
 
 
+def to_epoch_seconds(datetimes) -> np.ndarray:
+    datetimes = pd.to_datetime(pd.Series(datetimes), utc=True)
+    epoch = (datetimes - pd.Timestamp("1970-01-01", tz="UTC")) // pd.Timedelta("1s")
+    return epoch.to_numpy(dtype="int64")
+
+
+def build_author_embedding_index(
+    tdf: pd.DataFrame,
+    model=None,
+    embeddings=None,
+    authorcol: str = "author",
+    textcol: str = "sentence",
+    datetimecol: str = "datetime",
+    batch_size: int = 64,
+) -> dict:
+    """
+    Builds a time-aware index of sentence embeddings for every author in `tdf`.
+
+    The sentences are sorted by author and datetime and each one is encoded exactly
+    once. Within each author, we keep running sums of the embeddings, so the sum
+    of everything an author wrote before time t is a binary search plus a row lookup.
+    The sum points in the same direction as the mean embedding, which is all we need
+    for cosine similarity.
+
+    Parameters
+    ----------
+    tdf : pd.DataFrame
+        A text dataframe with columns for author, sentence, and datetime.
+    model : _type_, optional
+        A SentenceTransformer model. Only used if `embeddings` is None.
+    embeddings : np.ndarray, optional
+        Precomputed sentence embeddings, one row per row of `tdf`.
+    batch_size : int
+        Batch size passed to `model.encode`.
+
+    Returns
+    -------
+    index : dict
+        The author lookup, the sorted (author, time) search keys, the first row
+        of each author, and the per-author prefix sums of the embeddings.
+    """
+    # rows without an author (code -1, which would wrap around in the running sums)
+    # or a datetime can't match any edge, so they're left out of the index
+    rows = np.flatnonzero(tdf[datetimecol].notna().to_numpy())
+    codes, authors = pd.factorize(tdf[authorcol].iloc[rows])
+    rows, codes = rows[codes >= 0], codes[codes >= 0]
+    seconds = to_epoch_seconds(tdf[datetimecol].iloc[rows])
+    tmin = int(seconds.min()) if len(seconds) > 0 else 0
+    span = int(seconds.max()) - tmin + 1 if len(seconds) > 0 else 1
+    order = np.lexsort((seconds, codes))
+    codes, seconds, rows = codes[order], seconds[order], rows[order]
+
+    if embeddings is None:
+        texts = tdf[textcol].fillna("").to_numpy()[rows].tolist()
+        embeddings = model.encode(
+            texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=True
+        )
+    else:
+        embeddings = np.asarray(embeddings)[rows]
+
+    # running sums restart at the first sentence of each author
+    starts = np.searchsorted(codes, np.arange(len(authors)), side="left")
+    prefix = np.cumsum(embeddings, axis=0, dtype="float64")
+    offsets = np.zeros_like(prefix[: len(authors)])
+    offsets[1:] = prefix[starts[1:] - 1]
+    prefix -= offsets[codes]
+
+    return {
+        "authors": pd.Index(authors),
+        "keys": codes.astype("int64") * (span + 1) + (seconds - tmin),
+        "starts": starts,
+        "prefix": prefix.astype("float32"),
+        "tmin": tmin,
+        "span": span,
+    }
+
+
+def query_author_embeddings(index: dict, authors, datetimes):
+    """
+    Returns the summed embeddings of everything each author wrote strictly before
+    the matching datetime, and how many sentences went into each sum.
+    """
+    codes = index["authors"].get_indexer(pd.Series(authors))
+    seconds = to_epoch_seconds(datetimes)
+    known = codes >= 0
+    offset = np.clip(seconds - index["tmin"], 0, index["span"] + 1)
+    keys = codes.astype("int64") * (index["span"] + 1) + offset
+    end = np.searchsorted(index["keys"], keys, side="left")
+    counts = np.where(known, end - index["starts"][np.maximum(codes, 0)], 0)
+    sums = np.zeros((len(codes), index["prefix"].shape[1]), dtype="float32")
+    has_text = counts > 0
+    sums[has_text] = index["prefix"][end[has_text] - 1]
+    return sums, counts
+
+
+def rowwise_cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    dots = np.einsum("ij,ij->i", a, b)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(norms > 0, dots / norms, np.nan)
+
+
 def compute_ij_cosine_similarity_before_datetime(
+    edf: pd.DataFrame,
+    tdf: pd.DataFrame,
+    model,
+    method: str = "index",
+    embeddings=None,
+    batch_size: int = 64,
+) -> pd.DataFrame:
+    """
+    This function computes the cosine similarity between two nodes in a graph,
+    using only the text each author posted before their interaction.
+
+    With `method="index"` (the default), every sentence is encoded once and each
+    author is represented by the mean embedding of their sentences before the
+    interaction. All edges are then scored in one vectorized pass. Edges where
+    either author has no earlier text get NaN.
+
+    With `method="concatenate"`, we use the original approach of concatenating and
+    encoding each author's text for every edge. Note that SentenceTransformer silently
+    truncates its input to `model.max_seq_length` word pieces, so in that mode the
+    embedding only reflects the beginning of the concatenated text. That is why there
+    were never any 512 token warnings.
+
+    Parameters
+    ----------
+    edf : pd.DataFrame
+        An edgelist dataframe with columns for source, target, and datetime.
+    tdf : pd.DataFrame
+        A text dataframe with columns for author, sentence, and datetime.
+    model : _type_
+        A SetenceTransformer model.
+    method : str
+        Either "index" or "concatenate".
+    embeddings : np.ndarray, optional
+        Precomputed sentence embeddings aligned with the rows of `tdf` ("index" only).
+    batch_size : int
+        Batch size passed to `model.encode` ("index" only).
+
+    Returns
+    -------
+    edf : pd.DataFrame
+        An edgelist dataframe with cosine similarity scores for each ij interaction.
+    """
+    if method == "concatenate":
+        return compute_ij_cosine_similarity_concatenated(edf, tdf, model)
+    if method != "index":
+        raise ValueError(f"Unknown method '{method}'. Use 'index' or 'concatenate'.")
+
+    index = build_author_embedding_index(
+        tdf, model, embeddings=embeddings, batch_size=batch_size
+    )
+    i_sums, _ = query_author_embeddings(index, edf["source_author"], edf["datetime"])
+    j_sums, _ = query_author_embeddings(index, edf["target_author"], edf["datetime"])
+    edf["ij_cosine_similarity"] = rowwise_cosine_similarity(i_sums, j_sums)
+    return edf
+
+
+def compute_ij_cosine_similarity_concatenated(
     edf: pd.DataFrame, tdf: pd.DataFrame, model
 ) -> pd.DataFrame:
     """
@@ -276,6 +893,10 @@ def compute_ij_cosine_similarity_before_datetime(
     up to the moment of their interaction and does not consider any posts made after
     that specific interaction took place.
 
+    This is the original implementation, which filters `tdf` and encodes the
+    concatenated text of both authors for every single edge. It is slow, but it is
+    kept so we can compare results with the indexed version.
+
     I would have expected to hit a 512 token limit here, but I'm not getting any
     warnings or errors. The concatenated text from all posts up to the moment of
     interaction should certainly exceed 512. I'm not sure what's going on here, and
@@ -1,7 +1,19 @@
+import os
 import re
+import json
 import yaml
+import time
+import pickle
+import shutil
+import sqlite3
+import hashlib
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
+from collections import Counter
+from datetime import datetime, timezone
 
 
 def load_configs(
@@ -24,14 +36,462 @@ def configure_logging(task_name: str):
     )
 
 
-def load_parquet(filename: str):
-    return pd.read_parquet(f"../input/{filename}.parquet.gzip")
+def hash_path(path: str, h=None):
+    """
+    Feeds the bytes of a file, or of every file under a directory (in sorted
+    order, with their relative paths), into the hashlib object `h`.
+    """
+    h = hashlib.sha256() if h is None else h
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                h.update(os.path.relpath(full, path).encode())
+                hash_path(full, h)
+    else:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                h.update(block)
+    return h
+
+
+def task_data_path(name: str, where: str = "../input") -> str:
+    """
+    Resolves a name used with `load_parquet`/`save_parquet` (or a directory
+    output, like a parquet dataset or a saved model) to a path in `where`.
+    """
+    path = os.path.join(where, name)
+    return path if os.path.isdir(path) else f"{path}.parquet.gzip"
+
+
+def task_cache_dir() -> str:
+    return os.environ.get(
+        "PODLM_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "podlm")
+    )
+
+
+def task_cache_key(
+    task_file: str, config: dict, config_keys=(), inputs=(), models=()
+) -> str:
+    """
+    Content-addressed key for one run of a pipeline task: the task script, the
+    podlm source, the values of the `config_keys` the task reads, the bytes of
+    its `inputs` (names as passed to `load_parquet`) and the `models` it uses
+    (names, with a revision if it's pinned). Returns None if caching is turned
+    off with `task_cache: false` in the config.
+    """
+    if not config.get("task_cache", True):
+        return None
+    h = hashlib.sha256()
+    h.update(os.path.basename(task_file).encode())
+    hash_path(task_file, h)
+    podlm_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(podlm_dir)):
+        if name.endswith(".py"):
+            hash_path(os.path.join(podlm_dir, name), h)
+    settings = {k: config.get(k) for k in config_keys}
+    h.update(json.dumps([settings, list(models)], sort_keys=True, default=str).encode())
+    for name in inputs:
+        h.update(name.encode())
+        hash_path(task_data_path(name, "../input"), h)
+    return h.hexdigest()
+
+
+def _replace_path(source: str, target: str):
+    # copytree's dirs_exist_ok needs Python 3.8, and replacing the target also
+    # keeps stale files out of restored directories
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    elif os.path.exists(target):
+        os.remove(target)
+    if os.path.isdir(source):
+        shutil.copytree(source, target)
+    else:
+        shutil.copy2(source, target)
+
+
+def restore_task_outputs(key: str, outputs) -> bool:
+    """
+    Copies the cached `outputs` stored under `key` (see `task_cache_key`) into
+    ../output and returns True. If caching is off or any output isn't cached,
+    nothing is copied and it returns False, so the task has to run.
+    """
+    if key is None:
+        return False
+    entry = os.path.join(task_cache_dir(), key)
+    cached = [task_data_path(name, entry) for name in outputs]
+    if not all(os.path.exists(path) for path in cached):
+        return False
+    for path in cached:
+        _replace_path(path, os.path.join("../output", os.path.basename(path)))
+    logging.debug(f"Restored {', '.join(outputs)} from the task cache ({key[:12]}).")
+    return True
+
+
+def store_task_outputs(key: str, outputs):
+    """
+    Copies `outputs` from ../output into the task cache under `key`. The entry is
+    written to a temporary directory first and then renamed, so an interrupted
+    run never leaves a partial entry behind.
+    """
+    if key is None:
+        return
+    entry = os.path.join(task_cache_dir(), key)
+    tmp = f"{entry}.tmp-{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    for name in outputs:
+        path = task_data_path(name, "../output")
+        _replace_path(path, os.path.join(tmp, os.path.basename(path)))
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.replace(tmp, entry)
+
+
+class InferenceCache:
+    """
+    Persistent, size-bounded cache of per-text model outputs in a SQLite file,
+    keyed by (model id, sha1 of the text). It's shared by every analysis on the
+    machine, so sentences that were already labelled by a model (in any subreddit
+    or analysis) don't go through that model again. Values are pickled. When the
+    stored values exceed `max_bytes`, the least recently used entries are evicted.
+    `hits` and `misses` count lookups since the cache was opened.
+    """
+
+    def __init__(self, path: str = None, max_bytes: int = 20 * 2**30):
+        if path is None:
+            path = os.path.join(task_cache_dir(), "inference.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path, self.max_bytes = path, max_bytes
+        self.hits, self.misses = 0, 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (model TEXT, key BLOB, value BLOB, "
+            "size INTEGER, used REAL, UNIQUE (model, key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.conn.commit()
+        (size,) = self.conn.execute("SELECT SUM(size) FROM results").fetchone()
+        self.size = size or 0
+
+    @staticmethod
+    def text_key(text: str) -> bytes:
+        return hashlib.sha1(text.encode("utf-8")).digest()
+
+    def get_many(self, model: str, texts, chunk_size: int = 500) -> list:
+        """
+        Returns the cached value for each of `texts`, or None if it isn't cached.
+        """
+        # only strings can be cached, anything else is always a miss
+        keys = [self.text_key(t) if isinstance(t, str) else None for t in texts]
+        found = {}
+        for start in range(0, len(keys), chunk_size):
+            chunk = list(set(keys[start : start + chunk_size]) - {None})
+            marks = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT key, value FROM results WHERE model = ? AND key IN ({marks})",
+                [model] + chunk,
+            ).fetchall()
+            found.update((bytes(k), v) for k, v in rows)
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE results SET used = ? WHERE model = ? AND key = ?",
+                [(now, model, k) for k in found],
+            )
+            self.conn.commit()
+        values = [found.get(k) for k in keys]
+        n_hits = sum(v is not None for v in values)
+        self.hits += n_hits
+        self.misses += len(values) - n_hits
+        return [None if v is None else pickle.loads(v) for v in values]
+
+    def put_many(self, model: str, texts, values):
+        now = time.time()
+        rows = []
+        for text, value in zip(texts, values):
+            blob = pickle.dumps(value, protocol=4)
+            rows.append((model, self.text_key(text), blob, len(blob), now))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self.conn.commit()
+        self.size += sum(row[3] for row in rows)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self, target: float = 0.9):
+        """
+        Deletes the least recently used entries until the cache is below
+        `target` * `max_bytes`.
+        """
+        (size,) = self.conn.execute("SELECT SUM(size) FROM results").fetchone()
+        self.size = size or 0
+        excess = self.size - int(target * self.max_bytes)
+        if excess <= 0:
+            return
+        evicted, freed = [], 0
+        for rowid, size in self.conn.execute(
+            "SELECT rowid, size FROM results ORDER BY used"
+        ):
+            evicted.append((rowid,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany("DELETE FROM results WHERE rowid = ?", evicted)
+        self.conn.commit()
+        self.size -= freed
+        logging.debug(f"Evicted {len(evicted)} entries from the inference cache.")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "bytes": self.size,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def open_inference_cache(config: dict):
+    """
+    Opens the shared `InferenceCache`, or returns None if it's turned off with
+    `inference_cache: false` in the config.
+    """
+    if not config.get("inference_cache", True):
+        return None
+    max_gb = config.get("inference_cache_max_gb", 20)
+    return InferenceCache(max_bytes=int(max_gb * 2**30))
+
+
+def create_embedding_store(
+    filename: str, ids, dim: int, model_name: str, dtype: str = "float16"
+) -> np.memmap:
+    """
+    Creates a sentence embedding store in ../output/{filename}/: the `ids` its rows
+    are aligned to (`ids.parquet.gzip`), the model that produced the embeddings
+    (`meta.json`), and an empty (len(ids) x dim) `embeddings.npy`. It returns the
+    embeddings as a writable memmap, so they can be filled in chunks.
+    """
+    path = f"../output/{filename}"
+    os.makedirs(path, exist_ok=True)
+    ids = pd.DataFrame({"id_sentence": np.asarray(ids)})
+    ids.to_parquet(os.path.join(path, "ids.parquet.gzip"), compression="gzip")
+    with open(os.path.join(path, "meta.json"), "w") as file:
+        json.dump({"model": model_name, "dim": dim, "dtype": dtype}, file)
+    return np.lib.format.open_memmap(
+        os.path.join(path, "embeddings.npy"),
+        mode="w+",
+        dtype=dtype,
+        shape=(len(ids), dim),
+    )
+
+
+def load_embedding_store(filename: str, where: str = "../input") -> dict:
+    """
+    Opens a store written with `create_embedding_store`. The embeddings are
+    memory-mapped read-only, so only the rows that are actually used are read.
+    """
+    path = os.path.join(where, filename)
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+    ids = pd.read_parquet(os.path.join(path, "ids.parquet.gzip"))["id_sentence"]
+    return {
+        "embeddings": np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r"),
+        "ids": pd.Index(ids),
+        "model": meta["model"],
+    }
+
+
+def embeddings_for_ids(store: dict, ids) -> np.ndarray:
+    """
+    Returns the stored embeddings of `ids`, in that order, or None if any of them
+    isn't in the store.
+    """
+    positions = store["ids"].get_indexer(pd.Series(ids))
+    if (positions < 0).any():
+        return None
+    return store["embeddings"][positions]
+
+
+def fill_from_embedding_store(previous: dict, ids, out, chunk_size: int = 100000):
+    """
+    Copies the embeddings of the `ids` that are in the `previous` store into the
+    matching rows of `out`, and returns a mask of the rows that still need to be
+    encoded.
+    """
+    positions = previous["ids"].get_indexer(pd.Series(ids))
+    found = np.flatnonzero(positions >= 0)
+    for start in range(0, len(found), chunk_size):
+        rows = found[start : start + chunk_size]
+        out[rows] = previous["embeddings"][positions[rows]]
+    return positions < 0
+
+
+# text and id columns, stored as Arrow-backed strings by `apply_dtype_policy`
+STRING_COLUMNS = (
+    "id",
+    "parent_id",
+    "link_id",
+    "post_id",
+    "id_sentence",
+    "url",
+    "text",
+    "title",
+    "selftext",
+    "body",
+    "sentence",
+)
+# columns with few distinct values, stored as categories by `apply_dtype_policy`
+CATEGORICAL_COLUMNS = ("author", "subreddit", "domain")
+
+
+def arrow_string_dtype():
+    """
+    Returns the `string[pyarrow]` dtype, or None if this pandas/pyarrow can't make it.
+    """
+    try:
+        return pd.StringDtype("pyarrow")
+    except (ImportError, TypeError, ValueError):
+        return None
+
+
+def apply_dtype_policy(
+    df: pd.DataFrame,
+    strings=STRING_COLUMNS,
+    categoricals=CATEGORICAL_COLUMNS,
+) -> pd.DataFrame:
+    """
+    Stores the `strings` columns of `df` as Arrow-backed strings and the
+    `categoricals` columns as categories, in place. Python object columns hold one
+    Python object per value, which makes the frames several times larger than the
+    data and every copy (e.g. in a merge) slow. Columns that are already
+    Arrow-backed or categorical are left alone.
+    """
+    string_dtype = arrow_string_dtype()
+    for col in df.columns:
+        dtype = df[col].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if col in categoricals:
+            df[col] = df[col].astype("category")
+        elif col in strings and string_dtype is not None:
+            if dtype == object or getattr(dtype, "storage", None) == "python":
+                df[col] = df[col].astype(string_dtype)
+    return df
+
+
+def load_parquet(
+    filename: str,
+    columns=None,
+    filters=None,
+    arrow_dtypes: bool = False,
+    dtype_backend: str = None,
+):
+    """
+    Reads ../input/{filename}.parquet.gzip. Only the `columns` (all by default) and
+    the rows that match `filters` are read. Both are pushed down to pyarrow, which
+    skips the row groups whose statistics rule out every row. `filters` uses the
+    pyarrow format, e.g. `[("author", "!=", "[deleted]")]`.
+
+    With `arrow_dtypes`, the text, id and author columns get the dtypes of
+    `apply_dtype_policy`. `dtype_backend` is passed to `pd.read_parquet` (e.g.
+    "pyarrow", needs pandas >= 2.0).
+    """
+    kwargs = {} if dtype_backend is None else {"dtype_backend": dtype_backend}
+    if filters is not None:
+        kwargs["filters"] = filters
+    df = pd.read_parquet(f"../input/{filename}.parquet.gzip", columns=columns, **kwargs)
+    if arrow_dtypes:
+        apply_dtype_policy(df)
+    return df
 
 
 def save_parquet(df: pd.DataFrame, filename: str):
     df.to_parquet(f"../output/{filename}.parquet.gzip", compression="gzip")
 
 
+def arrow_schema(*dfs: pd.DataFrame) -> pa.Schema:
+    """
+    Returns the Arrow types of all columns in `dfs`, inferred from the full frames.
+    If a column appears in more than one frame, the first one wins.
+    """
+    fields = {}
+    for df in dfs:
+        for field in pa.Schema.from_pandas(df, preserve_index=False):
+            fields.setdefault(field.name, field)
+    return pa.schema(list(fields.values()))
+
+
+def has_null_type(dtype: pa.DataType) -> bool:
+    """
+    Whether `dtype` is null or contains a null type, e.g. `list<null>` for a column
+    of empty lists.
+    """
+    if pa.types.is_null(dtype):
+        return True
+    if pa.types.is_dictionary(dtype):
+        return has_null_type(dtype.value_type)
+    if pa.types.is_map(dtype):
+        return has_null_type(dtype.key_type) or has_null_type(dtype.item_type)
+    if pa.types.is_struct(dtype):
+        return any(has_null_type(field.type) for field in dtype)
+    if (
+        pa.types.is_list(dtype)
+        or pa.types.is_large_list(dtype)
+        or pa.types.is_fixed_size_list(dtype)
+    ):
+        return has_null_type(dtype.value_type)
+    return False
+
+
+def save_parquet_chunks(
+    chunks, filename: str, schema_hint: pa.Schema = None, row_group_size: int = None
+):
+    """
+    Writes an iterable of dataframes to a single parquet file, appending each chunk
+    as one or more row groups of at most `row_group_size` rows, so the full table
+    never has to be in memory. Every row group has column statistics, so readers
+    with filters (see `load_parquet`) can skip it. The file schema comes from the
+    first chunk. If the type of a column in that chunk is or contains null (no
+    non-null values, or only empty lists), its type is taken from `schema_hint`
+    (see `arrow_schema`).
+    """
+    writer, schema = None, schema_hint
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                for i, field in enumerate(schema):
+                    if has_null_type(field.type) and schema_hint is not None:
+                        if field.name in schema_hint.names:
+                            schema = schema.set(i, schema_hint.field(field.name))
+                writer = pq.ParquetWriter(
+                    f"../output/{filename}.parquet.gzip",
+                    schema,
+                    compression="gzip",
+                    write_statistics=True,
+                )
+            if not table.schema.equals(schema, check_metadata=False):
+                table = table.cast(schema)
+            writer.write_table(table, row_group_size=row_group_size)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        empty = pa.schema([]) if schema is None else schema
+        pq.write_table(
+            empty.empty_table(),
+            f"../output/{filename}.parquet.gzip",
+            compression="gzip",
+        )
+
+
 def merge_string_columns(
     df: pd.DataFrame, col1: pd.Series, col2: pd.Series, new_col_name: str, drop=True
 ):
@@ -54,10 +514,18 @@ def split_id_sentence_strings(s: str) -> str:
         return None
 
 
-def split_ids(df: pd.DataFrame, id_sentence: str = "id_sentence") -> pd.DataFrame:
-    df[["post_id", "sentence_position_in_post"]] = (
-        df[id_sentence].apply(split_id_sentence_strings).apply(pd.Series)
-    )
+def split_ids(
+    df: pd.DataFrame, id_sentence: str = "id_sentence", categorical: bool = False
+) -> pd.DataFrame:
+    """
+    Splits sentence ids like `t1_abc123_4` into the post id (`t1_abc123`) and the
+    position of the sentence in the post (`4`, as int16). With `categorical=True`,
+    the post ids are stored as a category, which is much smaller when posts have
+    many sentences.
+    """
+    parts = df[id_sentence].str.rsplit("_", n=1, expand=True).reindex(columns=[0, 1])
+    df["post_id"] = parts[0].astype("category") if categorical else parts[0]
+    df["sentence_position_in_post"] = parts[1].astype("int16")
     return df
 
 
@@ -76,6 +544,58 @@ def merge_feature_dfs(df_text_tasks, df_as_collected, on_cols):
     return merged
 
 
+def resolve_column_collisions(frames: dict, keys=()) -> dict:
+    """
+    Renames every column that appears in more than one of the named `frames` to
+    `<name>_<column>`, so they can be joined without suffixes or cleanup afterwards.
+    Columns in `keys` are left alone.
+    """
+    counts = Counter(c for df in frames.values() for c in df.columns if c not in keys)
+    resolved = {}
+    for name, df in frames.items():
+        collisions = {c: f"{name}_{c}" for c in df.columns if counts.get(c, 0) > 1}
+        resolved[name] = df.rename(columns=collisions)
+    return resolved
+
+
+def iter_merged_on_key(
+    frames: dict, key: str = "id_sentence", chunk_size: int = 100000
+):
+    """
+    Inner joins all of the named `frames` on `key` and yields the result in chunks
+    covering at most `chunk_size` distinct keys.
+
+    The keys of all frames are coded into one shared integer index and every frame
+    is sorted by it once. Each chunk is then just a slice of every frame plus
+    index-aligned joins, so the whole merged table never sits in memory at once.
+    Columns that appear in more than one frame are renamed up front with
+    `resolve_column_collisions`.
+    """
+    frames = resolve_column_collisions(frames, keys=[key])
+    index = pd.Index(
+        pd.unique(np.concatenate([df[key].to_numpy() for df in frames.values()]))
+    )
+    sorted_frames, sorted_codes = [], []
+    for df in frames.values():
+        codes = index.get_indexer(df[key])
+        order = np.argsort(codes, kind="stable")
+        df = df.drop(columns=key).iloc[order]
+        df.index = codes[order]
+        sorted_frames.append(df)
+        sorted_codes.append(codes[order])
+
+    for lo in range(0, len(index), chunk_size):
+        hi = lo + chunk_size
+        merged = None
+        for df, codes in zip(sorted_frames, sorted_codes):
+            start, end = np.searchsorted(codes, [lo, hi])
+            part = df.iloc[start:end]
+            merged = part if merged is None else merged.join(part, how="inner")
+        if merged is not None and len(merged) > 0:
+            merged.insert(0, key, index[merged.index])
+            yield merged.reset_index(drop=True)
+
+
 def group_and_aggregate_author_level(
     df, group_cols, sum_cols, str_cols, join_str_with=" "
 ):
@@ -0,0 +1,183 @@
+import os
+import glob
+import time
+import threading
+
+import numpy as np
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip("elasticsearch")
+from podlm import reddit
+
+DAY = 86400
+START = 1262304000  # 2010-01-01
+
+
+def fake_hits(n, n_days, subreddit="news", seed=0):
+    """Submission hits spread over `n_days` days, in random order like `scan`."""
+    rng = np.random.default_rng(seed)
+    days = rng.permutation(np.arange(n) % n_days)
+    return [
+        {
+            "_id": f"{subreddit}{i}",
+            "_source": {
+                "author": f"user{i % 7}",
+                "created_utc": int(START + day * DAY + 60),
+                "title": "title",
+                "selftext": "text",
+                "score": 1,
+                "num_comments": 0,
+                "subreddit": subreddit,
+            },
+        }
+        for i, day in enumerate(days)
+    ]
+
+
+def read_dataset(path):
+    dataset = ds.dataset(path, format="parquet", partitioning=reddit.YMD_PARTITIONING)
+    return dataset.to_table()
+
+
+def test_scan_to_dataset_with_more_days_than_pyarrow_partitions(tmp_path, monkeypatch):
+    hits = fake_hits(6000, 3000)
+    monkeypatch.setattr(reddit, "scan", lambda es, query, index, size: iter(hits))
+    path = str(tmp_path / "news_submissions")
+
+    n_rows = reddit.es_scan_to_dataset({}, None, path, chunk_size=1000)
+
+    table = read_dataset(path)
+    assert n_rows == table.num_rows == 6000
+    assert sorted(table["id"].to_pylist()) == sorted(f"t3_{h['_id']}" for h in hits)
+    assert len(os.listdir(path)) == 3000
+    # every day is written to one file with one row group, even though it shows up
+    # in several chunks
+    files = glob.glob(os.path.join(path, "*", "*.parquet"))
+    assert len(files) == 3000
+    assert all(pq.ParquetFile(f).num_row_groups == 1 for f in files)
+    assert all(
+        pq.ParquetFile(f).schema_arrow.names == table.column_names[:-1] for f in files
+    )
+
+
+def test_scan_to_dataset_compacts_row_groups(tmp_path, monkeypatch):
+    hits = fake_hits(20000, 365)
+    monkeypatch.setattr(reddit, "scan", lambda es, query, index, size: iter(hits))
+    path = str(tmp_path / "news_submissions")
+
+    reddit.es_scan_to_dataset({}, None, path, chunk_size=1000)
+
+    files = glob.glob(os.path.join(path, "*", "*.parquet"))
+    assert len(files) == 365
+    assert all(pq.ParquetFile(f).num_row_groups == 1 for f in files)
+    assert read_dataset(path).num_rows == 20000
+    assert not glob.glob(os.path.join(path, "*", ".*"))
+
+
+def test_filter_dataset_by_ids_with_more_days_than_pyarrow_partitions(tmp_path):
+    hits = fake_hits(3000, 3000)
+    path = str(tmp_path / "news_submissions")
+    reddit.write_hits_to_dataset(
+        hits, path, reddit.REDDIT_FIELDS["reddit-index-s"], "t3_"
+    )
+
+    ids = [f"t3_{h['_id']}" for h in hits[::2]]
+    reddit.filter_dataset_by_ids(path, ids)
+
+    assert sorted(read_dataset(path)["id"].to_pylist()) == sorted(ids)
+    files = glob.glob(os.path.join(path, "*", "*.parquet"))
+    assert all(pq.ParquetFile(f).num_row_groups == 1 for f in files)
+
+
+class FakeScan:
+    """
+    Stands in for `elasticsearch.helpers.scan`. Every (subreddit, index, slice)
+    gets its own hits. The `fail_once` slices raise after 80% of their hits on
+    their first attempt, so part of their files is already written.
+    """
+
+    def __init__(self, n_per_slice, fail_once=(), chunk_size=100):
+        self.n_per_slice = n_per_slice
+        self.fail_once = set(fail_once)
+        self.chunk_size = chunk_size
+        self.calls = []
+        self.running = self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, es, query, index, size):
+        subreddit = query["query"]["match"]["subreddit"]
+        slice_id = query.get("slice", {}).get("id", 0)
+        job = (subreddit, index, slice_id)
+        with self.lock:
+            self.calls.append(job)
+            fail = job in self.fail_once
+            self.fail_once.discard(job)
+        hits = fake_hits(self.n_per_slice, 30, f"{subreddit}{index[-1]}{slice_id}-")
+        return self.hits(hits, fail)
+
+    def hits(self, hits, fail):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            for i, hit in enumerate(hits):
+                if i % self.chunk_size == 0:
+                    time.sleep(0.01)
+                if fail and i == len(hits) * 4 // 5:
+                    raise ConnectionError("scroll expired")
+                yield hit
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_parallel_stream_retries_failed_slices(tmp_path, monkeypatch):
+    failing = ("news", "reddit-index-c", 1)
+    scan = FakeScan(n_per_slice=500, fail_once=[failing])
+    monkeypatch.setattr(reddit, "scan", scan)
+    removed = []
+    remove_slice_files = reddit.remove_slice_files
+
+    def spy(path, slice_id, run_id=""):
+        removed.append((os.path.basename(path), slice_id))
+        remove_slice_files(path, slice_id, run_id)
+
+    monkeypatch.setattr(reddit, "remove_slice_files", spy)
+
+    counts = reddit.es_parallel_stream_reddit_to_parquet(
+        ["news", "science"],
+        None,
+        str(tmp_path),
+        n_slices=3,
+        max_workers=4,
+        chunk_size=100,
+        retries=1,
+    )
+
+    # 2 subreddits x 2 indices x 3 slices, plus the retry
+    assert len(scan.calls) == 13 and scan.calls.count(failing) == 2
+    assert scan.max_running > 1
+    assert removed == [("news_comments", 1)]
+    for search in ["news", "science"]:
+        for index, kind in reddit.REDDIT_KINDS.items():
+            assert counts[(search, index)] == 1500
+            ids = read_dataset(str(tmp_path / f"{search}_{kind}"))["id"].to_pylist()
+            assert len(ids) == len(set(ids)) == 1500
+            prefix = reddit.REDDIT_ID_PREFIXES[index]
+            assert all(i.startswith(f"{prefix}{search}{index[-1]}") for i in ids)
+
+
+def test_parallel_stream_raises_after_retries(tmp_path, monkeypatch):
+    failing = ("news", "reddit-index-s", 0)
+    scan = FakeScan(n_per_slice=500, fail_once=[failing])
+    monkeypatch.setattr(reddit, "scan", scan)
+
+    with pytest.raises(ConnectionError):
+        reddit.es_parallel_stream_reddit_to_parquet(
+            ["news"], None, str(tmp_path), n_slices=2, chunk_size=100, retries=0
+        )
+    # the failed slice's partial files are removed
+    path = str(tmp_path / "news_submissions")
+    assert glob.glob(os.path.join(path, "*", "part-0-*.parquet")) == []
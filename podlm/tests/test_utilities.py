@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from podlm import utilities
+
+
+@pytest.fixture
+def task_dir(tmp_path, monkeypatch):
+    """A pdpp task layout, run from src/ like the pipeline scripts."""
+    for name in ["input", "output", "src"]:
+        (tmp_path / name).mkdir()
+    monkeypatch.chdir(tmp_path / "src")
+    return tmp_path
+
+
+def read_output(task_dir, filename):
+    return pd.read_parquet(task_dir / "output" / f"{filename}.parquet.gzip")
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        # the first chunk has no matches, so its column is list<null>
+        [[[]], [["you"]], [[], ["I", "me"]]],
+        # a later chunk has no matches
+        [[["you"]], [[]], [[], ["I", "me"]]],
+        # no values at all in the first chunk
+        [[None], [["you"]], [[], ["I", "me"]]],
+    ],
+)
+def test_save_parquet_chunks_takes_null_types_from_the_hint(task_dir, chunks):
+    frames = [
+        pd.DataFrame({"id_sentence": [f"{i}_{j}" for j in range(len(c))], "you": c})
+        for i, c in enumerate(chunks)
+    ]
+    hint = utilities.arrow_schema(pd.concat(frames, ignore_index=True))
+
+    utilities.save_parquet_chunks(iter(frames), "merged", hint)
+
+    merged = read_output(task_dir, "merged")
+    values = [None if v is None else list(v) for v in merged["you"]]
+    assert values == [v for chunk in chunks for v in chunk]
+    assert merged["id_sentence"].tolist() == [
+        i for frame in frames for i in frame["id_sentence"]
+    ]
+
+
+def test_has_null_type():
+    assert utilities.has_null_type(pa.null())
+    assert utilities.has_null_type(pa.list_(pa.null()))
+    assert utilities.has_null_type(pa.struct([("a", pa.list_(pa.null()))]))
+    assert not utilities.has_null_type(pa.list_(pa.string()))
+    assert not utilities.has_null_type(pa.dictionary(pa.int32(), pa.string()))
+
+
+def write_sentence_level_inputs(task_dir, n_posts=2000, sentences_per_post=3):
+    rng = np.random.default_rng(0)
+    ids = [f"t1_{i:06x}" for i in range(n_posts)]
+    posts = pd.DataFrame(
+        {
+            "author": [f"user{i}" for i in rng.integers(0, 50, n_posts)],
+            "id": ids,
+            "parent_id": ["t3_root"] * n_posts,
+            "subreddit": "news",
+            "domain": "self.news",
+            "url": [f"https://reddit.com/{i}" for i in ids],
+            "text": ["a post about something"] * n_posts,
+            "score": rng.integers(0, 100, n_posts),
+        }
+    )
+    sentences = [f"{i}_{j}" for i in ids for j in range(sentences_per_post)]
+    sentiment = pd.DataFrame(
+        {"id_sentence": sentences, "sentiment_positive": rng.random(len(sentences))}
+    )
+    topics = pd.DataFrame(
+        {
+            "id_sentence": sentences[::-1],
+            "sentence": ["a sentence"] * len(sentences),
+            "topic": rng.integers(-1, 5, len(sentences)),
+        }
+    )
+    for name, df in [("posts", posts), ("sentiment", sentiment), ("topics", topics)]:
+        df.to_parquet(task_dir / "input" / f"r_{name}.parquet.gzip", compression="gzip")
+
+
+def merge_sentence_level(arrow_dtypes):
+    frames = {
+        task: utilities.load_parquet(f"r_{task}", arrow_dtypes=arrow_dtypes)
+        for task in ["sentiment", "topics"]
+    }
+    columns = ["author", "id", "parent_id", "subreddit", "domain", "url", "score"]
+    posts = utilities.load_parquet("r_posts", columns, arrow_dtypes=arrow_dtypes)
+    posts = posts.rename(columns={"id": "post_id"}).set_index("post_id")
+    schema_hint = utilities.arrow_schema(*frames.values(), posts.reset_index())
+    chunks = (
+        utilities.split_ids(chunk).join(posts, on="post_id", how="inner")
+        for chunk in utilities.iter_merged_on_key(frames, "id_sentence", 1000)
+    )
+    filename = f"merged_{int(arrow_dtypes)}"
+    utilities.save_parquet_chunks(chunks, filename, schema_hint)
+    return filename
+
+
+def test_dtype_policy_reduces_memory(task_dir):
+    write_sentence_level_inputs(task_dir)
+    for name in ["r_posts", "r_topics"]:
+        # Python object columns, as pandas < 2 loads strings
+        plain = utilities.load_parquet(name)
+        plain = plain.astype({col: object for col in plain.select_dtypes("string")})
+        small = utilities.apply_dtype_policy(plain.copy())
+        assert small.memory_usage(deep=True).sum() < plain.memory_usage(deep=True).sum()
+        pd.testing.assert_frame_equal(
+            small.astype(object), plain.astype(object), check_dtype=False
+        )
+    posts = utilities.load_parquet("r_posts", arrow_dtypes=True)
+    assert all(
+        isinstance(posts[col].dtype, pd.CategoricalDtype)
+        for col in utilities.CATEGORICAL_COLUMNS
+    )
+    assert all(
+        isinstance(posts[col].dtype, pd.StringDtype) for col in ["id", "url", "text"]
+    )
+
+
+def test_dtype_policy_keeps_merged_values(task_dir):
+    write_sentence_level_inputs(task_dir)
+    merged = [
+        read_output(task_dir, merge_sentence_level(arrow_dtypes))
+        for arrow_dtypes in [False, True]
+    ]
+    plain, small = [
+        df.astype(object).sort_values("id_sentence", ignore_index=True) for df in merged
+    ]
+    assert len(plain) == 6000
+    pd.testing.assert_frame_equal(small, plain)